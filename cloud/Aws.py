@@ -2,7 +2,11 @@ from . import CloudEnvironment
 import logging
 import sys
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from boto3.s3.transfer import TransferConfig
+from boto3.exceptions import S3UploadFailedError
 from botocore.exceptions import ClientError
 
 # logging
@@ -15,6 +19,28 @@ logger = logging.getLogger()
 class AwsEnvironment(CloudEnvironment):
     def __init__(self, source, *args, **kwargs) -> None:
         super().__init__(source, *args, **kwargs)
+        self._s3_client = None
+        self.upload_metrics = {}
+
+    @property
+    def s3_client(self):
+        """
+        S3 client shared by every upload (boto3 clients are thread safe).
+        """
+        if self._s3_client is None:
+            self._s3_client = boto3.client(
+                's3',
+                endpoint_url=self.storage.get('endpoint_url',None))
+        return self._s3_client
+
+    @property
+    def transfer_config(self)->TransferConfig:
+        mb = 1024 * 1024
+        return TransferConfig(
+            multipart_threshold=int(self.storage.get('multipart_threshold_mb',8))*mb,
+            multipart_chunksize=int(self.storage.get('multipart_chunksize_mb',8))*mb,
+            max_concurrency=int(self.storage.get('multipart_concurrency',4)),
+            use_threads=True)
     
     def upload_file(self,file_name, bucket, object_name=None):
         """Upload a file to an S3 bucket
@@ -30,20 +56,67 @@ class AwsEnvironment(CloudEnvironment):
             object_name = os.path.basename(file_name)
 
         # Upload the file
-        s3_client = boto3.client('s3')
         try:
-            response = s3_client.upload_file(file_name, bucket, object_name)
-        except ClientError as e:
+            response = self.s3_client.upload_file(
+                file_name, 
+                bucket, 
+                object_name,
+                Config=self.transfer_config)
+        except (ClientError,S3UploadFailedError) as e:
             logging.error(e)
             return False
         return True
     
     def upload_file_to_storage(self,file_name, storage_root, object_name,*args, **kwargs):
-        self.upload_file(
+        return self.upload_file(
             file_name=file_name, 
             bucket=storage_root, 
             object_name=object_name)
 
+    def upload_files_to_storage(self,files, storage_root, object_prefix='',*args, **kwargs)->dict:
+        """
+        Upload files in parallel over the shared client.
+
+        At most storage['upload_workers'] files are in flight at once,
+        object names are object_prefix/file_name. Returns aggregated 
+        metrics, also kept in upload_metrics.
+        """
+        workers = max(int(self.storage.get('upload_workers',8)),1)
+        # create the client before the threads, boto3 sessions are not 
+        # thread safe
+        self.s3_client
+        started = time.perf_counter()
+        def upload(file_name):
+            object_name = file_name
+            if object_prefix:
+                object_name = str(object_prefix).rstrip('/')+'/'+file_name
+            if self.upload_file(file_name,storage_root,object_name) is False:
+                return file_name,None
+            return file_name,os.path.getsize(file_name)
+
+        metrics = {
+            'uploaded_files':0,
+            'failed_files':0,
+            'uploaded_bytes':0,
+            'upload_seconds':0.0,
+            'upload_mb_per_second':0.0
+        }
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for file_name, size in executor.map(upload,files):
+                if size is None:
+                    logger.error(f'failed to upload {file_name}')
+                    metrics['failed_files'] += 1
+                    continue
+                metrics['uploaded_files'] += 1
+                metrics['uploaded_bytes'] += size
+        metrics['upload_seconds'] = time.perf_counter() - started
+        if metrics['upload_seconds'] > 0:
+            metrics['upload_mb_per_second'] = round(
+                metrics['uploaded_bytes'] / 1024 / 1024 / metrics['upload_seconds'],3)
+        self.upload_metrics = metrics
+        logger.info(f'uploaded {metrics["uploaded_files"]} files to {storage_root}')
+        return metrics
+
     def copy_csv_storage_to_database(self, file, table, conn, *args, **kwargs):
         return super().copy_csv_storage_to_database(file, table, conn, *args, **kwargs)
     
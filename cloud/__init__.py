@@ -1,6 +1,7 @@
 
 import sys
 import os
+import time
 import logging
 import json
 import yaml
@@ -89,4 +90,33 @@ class CloudEnvironment:
         print(self.connections)
     
     def upload_file_to_storage(self,file_name, storage_root, object_name,*args, **kwargs):
-        pass
\ No newline at end of file
+        pass
+
+    def upload_files_to_storage(self,files, storage_root, object_prefix='',*args, **kwargs)->dict:
+        """
+        Upload many files, object names are object_prefix/file_name.
+
+        Returns aggregated upload metrics. Environments override this 
+        to upload in parallel.
+        """
+        metrics = {
+            'uploaded_files':0,
+            'failed_files':0,
+            'uploaded_bytes':0,
+            'upload_seconds':0.0
+        }
+        started = time.perf_counter()
+        for file_name in files:
+            object_name = file_name
+            if object_prefix:
+                object_name = str(object_prefix).rstrip('/')+'/'+file_name
+            if self.upload_file_to_storage(
+                    file_name,
+                    storage_root,
+                    object_name,*args, **kwargs) is False:
+                metrics['failed_files'] += 1
+                continue
+            metrics['uploaded_files'] += 1
+            metrics['uploaded_bytes'] += os.path.getsize(file_name)
+        metrics['upload_seconds'] = time.perf_counter() - started
+        return metrics
\ No newline at end of file
@@ -1,7 +1,14 @@
 __all__ = [
+    'benchmarks',
+    'chunk_store',
+    'dumps',
     'etl',
+    'fingerprints',
     'pipelines',
     'process',
+    'profiling',
+    'runner',
     'sources',
+    'state',
     'targets'
 ]
\ No newline at end of file
@@ -0,0 +1,145 @@
+import collections
+import logging
+import sys
+import threading
+import numpy
+import pandas
+
+from .dumps import read_dump
+
+# logging
+logging.basicConfig(
+    stream=sys.stdout, 
+    level=logging.INFO,
+    format='[%(asctime)s] %(levelname)s - %(message)s'
+    )
+logger = logging.getLogger()
+
+def frame_size(df:pandas.DataFrame,sample_rows:int=1000)->int:
+    """
+    Memory of df in bytes. Object (string) columns are measured deep on
+    a sample of sample_rows rows and extrapolated, a shallow count only
+    sees their 8 byte pointers.
+    """
+    shallow = df.memory_usage(index=True,deep=False)
+    objects = [c for c in df.columns if df[c].dtype == object]
+    if not objects or len(df) == 0:
+        return int(shallow.sum())
+    sample = df[objects]
+    if len(df) > sample_rows:
+        positions = numpy.linspace(0,len(df)-1,sample_rows).astype('int64')
+        sample = sample.iloc[positions]
+    deep = sample.memory_usage(index=False,deep=True).sum() * len(df) / len(sample)
+    return int(shallow.drop(labels=objects).sum() + deep)
+
+class ChunkStore:
+    """
+    Dumped chunks shared between source and target, the store is the
+    only owner of the chunk frames.
+
+    Chunks stay in memory while their total size (see frame_size) fits
+    memory_budget_mb, least recently used chunks are dropped past that
+    and read back from their dump file.
+    """
+    def __init__(self,memory_budget_mb:float) -> None:
+        self.memory_budget = int(float(memory_budget_mb) * 1024 * 1024)
+        self.memory_bytes = 0
+        self._memory = collections.OrderedDict()
+        self._sizes = {}
+        self._paths = {}
+        self._lock = threading.Lock()
+        self.metrics:dict = {
+            'chunk_memory_hits':0,
+            'chunk_disk_reads':0,
+            'chunk_evictions':0
+        }
+
+    def __contains__(self,key):
+        return key in self._memory or key in self._paths
+
+    def __len__(self):
+        return len(set(self._memory) | set(self._paths))
+
+    def put(self,key,df:pandas.DataFrame,path:str):
+        """
+        Keep df under key, path is the dump file holding it.
+        """
+        size = frame_size(df)
+        with self._lock:
+            self._drop(key)
+            self._paths[key] = path
+            self._memory[key] = df
+            self._sizes[key] = size
+            self.memory_bytes += size
+            self._evict()
+
+    def get(self,key)->pandas.DataFrame:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.metrics['chunk_memory_hits'] += 1
+                return self._memory[key]
+            path = self._paths.get(key,None)
+        if path is None:
+            # not stored, key is the dump file itself
+            path = key
+        self.metrics['chunk_disk_reads'] += 1
+        return read_dump(path)
+
+    def discard(self,key):
+        """
+        Release the memory copy of a consumed chunk.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._drop_memory(key)
+
+    def clear(self):
+        """
+        Forget every chunk, dumps are kept.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._sizes.clear()
+            self._paths.clear()
+            self.memory_bytes = 0
+
+    def _drop_memory(self,key):
+        self._memory.pop(key)
+        self.memory_bytes -= self._sizes.pop(key,0)
+
+    def _drop(self,key):
+        if key in self._memory:
+            self._drop_memory(key)
+        self._paths.pop(key,None)
+
+    def _evict(self):
+        while self.memory_bytes > self.memory_budget and len(self._memory) > 1:
+            key = next(iter(self._memory))
+            self._drop_memory(key)
+            self.metrics['chunk_evictions'] += 1
+
+def check_string_eviction(rows:int=20000)->dict:
+    """
+    Self check: chunks of strings past the budget must be evicted, which
+    a shallow size would miss.
+    """
+    df = pandas.DataFrame({
+        'id':numpy.arange(rows),
+        'name':[f'customer name {i:08d} '*4 for i in range(rows)]
+    })
+    budget_mb = df.memory_usage(index=True,deep=True).sum() * 1.5 / 1024 / 1024
+    store = ChunkStore(budget_mb)
+    for index in range(3):
+        # only the memory copies are checked, the dumps are never read
+        store.put(f'chunk_{index}.csv',df,f'chunk_{index}.csv')
+    assert store.memory_bytes <= store.memory_budget, store.memory_bytes
+    assert store.metrics['chunk_evictions'] == 2, store.metrics
+    return {
+        'memory_bytes':store.memory_bytes,
+        'memory_budget':store.memory_budget,
+        **store.metrics
+    }
+
+if __name__ == '__main__':
+    print(check_string_eviction())
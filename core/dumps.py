@@ -0,0 +1,73 @@
+import pandas
+
+# dump_format -> file extension
+DUMP_EXTENSIONS = {
+    'csv':'csv',
+    'parquet':'parquet',
+    'feather':'arrow',
+    'arrow':'arrow'
+}
+
+def dump_filename(slice_index,pipeline_pid,dump_format='csv')->str:
+    fmt = str(dump_format).lower()
+    if fmt not in DUMP_EXTENSIONS:
+        raise ValueError(f'Unknown dump format {dump_format}')
+    return f'slice_{slice_index}_{pipeline_pid}.{DUMP_EXTENSIONS[fmt]}'
+
+# compression used when none is configured
+DEFAULT_COMPRESSION = {
+    'parquet':'snappy',
+    'feather':'lz4',
+    'arrow':'lz4'
+}
+
+def write_dump(df:pandas.DataFrame,filename:str,dump_format='csv',compression=None):
+    """
+    Write a chunk dump.
+
+    csv keeps the historical uncompressed format (compression is 
+    ignored), parquet accepts snappy (default)/zstd/gzip and feather 
+    (Arrow IPC) lz4 (default)/zstd compression, 'none' writes columnar
+    dumps uncompressed. Columnar formats keep dtypes (timestamps, 
+    nullable ints).
+    """
+    fmt = str(dump_format).lower()
+    if compression is None:
+        compression = DEFAULT_COMPRESSION.get(fmt,None)
+    elif str(compression).lower() in ('none','uncompressed'):
+        compression = None
+    match fmt:
+        case 'csv':
+            df.to_csv(
+                filename,
+                header=True,
+                index=False
+            )
+        case 'parquet':
+            df.to_parquet(
+                filename,
+                index=False,
+                compression=compression
+            )
+        case 'feather' | 'arrow':
+            if str(compression).lower() == 'snappy':
+                raise ValueError('Arrow IPC dumps support zstd or lz4 compression')
+            df.reset_index(drop=True).to_feather(
+                filename,
+                compression=compression or 'uncompressed'
+            )
+        case _:
+            raise ValueError(f'Unknown dump format {dump_format}')
+    return filename
+
+def read_dump(filename:str)->pandas.DataFrame:
+    """
+    Read a chunk dump written by write_dump, columnar dumps are memory
+    mapped instead of parsed.
+    """
+    if filename.endswith('.parquet'):
+        return pandas.read_parquet(filename,memory_map=True)
+    if filename.endswith('.arrow'):
+        from pyarrow import feather
+        return feather.read_table(filename,memory_map=True).to_pandas()
+    return pandas.read_csv(filename)
@@ -1,6 +1,15 @@
+import asyncio
+import os
+import queue
+import threading
+import time
 from .pipelines import (
     Pipeline, PipelineConfig
 )
+from .exceptions import PipelineConfigException
+
+# marks the end of the extraction in OVERLAP mode
+_END_OF_STREAM = object()
 
 class EtlPipeline(Pipeline):
     def __init__(self, config: PipelineConfig | str, *args, **kwargs) -> None:
@@ -16,20 +25,216 @@ class EtlPipeline(Pipeline):
     
     def load_to_target(self,*args,**kwargs):
         self.logger.info('Loading data')
+        if self.chunk_store is not None:
+            # the target reads the chunks from the store
+            self.target.load([])
+            return
         self.target.load(self.source.data)
 
     
+    def load_deltas(self):
+        """
+        Diff the extract against the target row hashes and apply the 
+        resulting inserts, updates and deletes.
+        """
+        if not getattr(self.target,'row_hash_column',None):
+            raise ValueError('DELTA pipelines need a target row_hash_column')
+        self.logger.info('Computing deltas')
+        deltas = self.source.populate_deltas(
+            self.target.load_hash_snapshot(),
+            self.target.row_hash_column,
+            primary_key=self.source.primary_key or self.target.conflict_key_columns,
+            ignore_fields=self.config.md5_ignore_fields)
+        self.target.apply_deltas(deltas)
+
+    def upload_dump(self,filename):
+        self.env.upload_file_to_storage(
+            file_name=filename,
+            storage_root=self.env.storage['storage_root'],
+            object_name=self.env.storage['temp_files_dir']+'/'+filename
+        )
+
+    def upload_dumps(self):
+        """
+        Upload every dump of the extraction to the storage.
+        """
+        with self.profiler.stage('upload',chunks=0) as stage:
+            upload_metrics = self.env.upload_files_to_storage(
+                self.source.csv_chunks_files,
+                storage_root=self.env.storage['storage_root'],
+                object_prefix=self.env.storage['temp_files_dir']
+            )
+            stage['bytes'] += upload_metrics.get('uploaded_bytes',0)
+            stage['chunks'] += upload_metrics.get('uploaded_files',0)
+        self.metrics.update(upload_metrics)
+
+    def load_streamed_chunk(self, chunk, *args, **kwargs):
+        """
+        Transform a single chunk, upload the dumps written so far and
+        hand the chunk to the target.
+        """
+        with self.profiler.stage('transform',rows=len(chunk)):
+            transformed = self.transform(chunk,*args, **kwargs)
+        if transformed is not None:
+            chunk = transformed
+        if self.config.dump_data_csv:
+            files = self.source.csv_chunks_files
+            for filename in files[self._uploaded_dumps:]:
+                with self.profiler.stage('upload',bytes=os.path.getsize(filename)):
+                    self.upload_dump(filename)
+            self._uploaded_dumps = len(files)
+        with self.profiler.stage('load',rows=len(chunk)):
+            self.target.load_chunk(chunk)
+
+    def run_streaming(self, *args, **kwargs):
+        """
+        Pull one chunk at a time from the source, transform it and hand
+        it to the target. Peak memory is set by the chunk size.
+        """
+        self.logger.info('Streaming data from source to target')
+        self._uploaded_dumps = 0
+        for chunk in self.profiler.iterate('extract',self.source.iter_chunks()):
+            self.load_streamed_chunk(chunk,*args, **kwargs)
+
+    def run_overlapped(self, *args, **kwargs):
+        """
+        Streaming run where a thread extracts chunk N+1 while chunk N is
+        transformed and loaded. Both sides are connected by a queue of 
+        queue_size chunks, errors on either side stop the other one.
+        """
+        self.logger.info('Streaming data from source to target (overlapped)')
+        self._uploaded_dumps = 0
+        chunks = queue.Queue(maxsize=max(int(self.config.queue_size),1))
+        stop = threading.Event()
+        # time the source waited on a full queue (target bound) and
+        # time the target waited on an empty queue (source bound)
+        self.metrics['extract_wait_seconds'] = 0.0
+        self.metrics['load_wait_seconds'] = 0.0
+
+        def put(item):
+            started = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    chunks.put(item,timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            self.metrics['extract_wait_seconds'] += time.perf_counter() - started
+
+        def produce():
+            try:
+                for chunk in self.profiler.iterate('extract',self.source.iter_chunks()):
+                    if stop.is_set():
+                        return
+                    put(chunk)
+                put(_END_OF_STREAM)
+            except BaseException as e:
+                put(e)
+
+        producer = threading.Thread(
+            target=produce,
+            name='borderliner-extract',
+            daemon=True)
+        producer.start()
+        try:
+            while True:
+                started = time.perf_counter()
+                item = chunks.get()
+                self.metrics['load_wait_seconds'] += time.perf_counter() - started
+                if item is _END_OF_STREAM:
+                    break
+                if isinstance(item,BaseException):
+                    raise item
+                self.load_streamed_chunk(item,*args, **kwargs)
+        finally:
+            stop.set()
+            producer.join()
+
     def run(self, *args, **kwargs):
-        self.extract()
-        self.source._data = self.transform(self.source._data,*args, **kwargs)
+        if self.config.async_io:
+            raise PipelineConfigException(
+                'async_io pipelines run on an event loop, use find_entry_point or run_async')
+        match str(self.config.execution_mode).upper():
+            case 'STREAM':
+                self.run_streaming(*args, **kwargs)
+                self.finish_load()
+                return
+            case 'OVERLAP':
+                self.run_overlapped(*args, **kwargs)
+                self.finish_load()
+                return
+        with self.profiler.stage('extract'):
+            self.extract()
+        rows = self.source.metrics['total_rows']
+        self.profiler.add('extract',rows=rows)
+        with self.profiler.stage('transform',rows=rows):
+            transformed = self.transform(self.source._data,*args, **kwargs)
+        if transformed is not None:
+            self.source._data = transformed
         if self.config.dump_data_csv:
-            for filename in self.source.csv_chunks_files:
-                #file_name, bucket, object_name=None
-                self.env.upload_file_to_storage(
-                    file_name=filename,
-                    storage_root=self.env.storage['storage_root'],
-                    object_name=self.env.storage['temp_files_dir']+'/'+filename
-                )
-        self.load_to_target()
+            self.upload_dumps()
+        with self.profiler.stage('load',rows=rows):
+            if str(self.config.pipeline_method).upper() == 'DELTA':
+                self.load_deltas()
+            else:
+                self.load_to_target()
+        self.finish_load()
         #self.logger.info(self.target.metrics)
-        
\ No newline at end of file
+
+    async def aload_streamed_chunk(self, chunk, *args, **kwargs):
+        with self.profiler.stage('transform',rows=len(chunk)):
+            transformed = self.transform(chunk,*args, **kwargs)
+        if transformed is not None:
+            chunk = transformed
+        if self.config.dump_data_csv:
+            files = self.source.csv_chunks_files
+            for filename in files[self._uploaded_dumps:]:
+                with self.profiler.stage('upload',bytes=os.path.getsize(filename)):
+                    await asyncio.to_thread(self.upload_dump,filename)
+            self._uploaded_dumps = len(files)
+        with self.profiler.stage('load',rows=len(chunk)):
+            await self.target.aload_chunk(chunk)
+
+    async def arun(self, *args, **kwargs):
+        """
+        Streaming run on the event loop for async_io pipelines: network
+        waits of the source and the target let other pipelines of the 
+        loop run. Stage timings include the time the loop spent on the
+        other pipelines.
+        """
+        if not self.config.async_io:
+            return await super().arun(*args, **kwargs)
+        self._uploaded_dumps = 0
+        if str(self.config.pipeline_method).upper() == 'DELTA':
+            with self.profiler.stage('extract'):
+                await self.source.aextract()
+            rows = self.source.metrics['total_rows']
+            self.profiler.add('extract',rows=rows)
+            with self.profiler.stage('transform',rows=rows):
+                transformed = self.transform(self.source._data,*args, **kwargs)
+            if transformed is not None:
+                self.source._data = transformed
+            if self.config.dump_data_csv:
+                await asyncio.to_thread(self.upload_dumps)
+            if not getattr(self.target,'row_hash_column',None):
+                raise ValueError('DELTA pipelines need a target row_hash_column')
+            deltas = self.source.populate_deltas(
+                await self.target.aload_hash_snapshot(),
+                self.target.row_hash_column,
+                primary_key=self.source.primary_key or self.target.conflict_key_columns,
+                ignore_fields=self.config.md5_ignore_fields)
+            with self.profiler.stage('load',rows=rows):
+                await self.target.aapply_deltas(deltas)
+            self.finish_load()
+            return
+        chunks = self.source.aiter_chunks()
+        while True:
+            with self.profiler.stage('extract',chunks=0) as stage:
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                stage['chunks'] += 1
+                stage['rows'] += len(chunk)
+            await self.aload_streamed_chunk(chunk,*args, **kwargs)
+        self.finish_load()
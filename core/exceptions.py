@@ -1,2 +1,5 @@
 class PipelineConfigException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class PipelineExtractionException(Exception):
+    pass
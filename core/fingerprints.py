@@ -0,0 +1,154 @@
+import numpy
+import pandas
+
+def row_fingerprints(df:pandas.DataFrame,ignore_fields=())->pandas.Series:
+    """
+    Vectorized per-row hash over every column except ignore_fields.
+
+    Hashes are uint64 values from pandas.util.hash_pandas_object and 
+    depend on the column dtypes, keep them stable between runs.
+    """
+    ignore = set(str(c).lower() for c in ignore_fields)
+    columns = [c for c in df.columns if str(c).lower() not in ignore]
+    return pandas.util.hash_pandas_object(
+        df[columns],
+        index=False,
+        categorize=True)
+
+def fingerprint_to_text(hashes:pandas.Series)->pandas.Series:
+    """
+    uint64 hashes as signed decimal text, the way they are stored in 
+    the target row hash column.
+    """
+    return pandas.Series(
+        hashes.values.astype(numpy.uint64).view(numpy.int64),
+        index=hashes.index).astype(str)
+
+def align_key_dtypes(df:pandas.DataFrame,snapshot:pandas.DataFrame,key_cols:list):
+    """
+    Key columns of df and snapshot cast to a common dtype per column, so
+    an integer key matches the same float key (1 and 1.0). Keys without
+    a common numeric or datetime dtype are compared as text.
+    """
+    source = df[key_cols].copy()
+    target = snapshot[key_cols].copy()
+    for col in key_cols:
+        left, right = source[col], target[col]
+        if left.dtype == right.dtype:
+            continue
+        if pandas.api.types.is_numeric_dtype(left) \
+            and pandas.api.types.is_numeric_dtype(right) \
+            and not pandas.api.types.is_bool_dtype(left) \
+            and not pandas.api.types.is_bool_dtype(right):
+            common = numpy.result_type(left.dtype,right.dtype) \
+                if isinstance(left.dtype,numpy.dtype) and isinstance(right.dtype,numpy.dtype) \
+                else numpy.float64
+            source[col] = left.astype(common)
+            target[col] = right.astype(common)
+        elif pandas.api.types.is_datetime64_any_dtype(left) \
+            and pandas.api.types.is_datetime64_any_dtype(right):
+            source[col] = pandas.to_datetime(left,utc=True)
+            target[col] = pandas.to_datetime(right,utc=True)
+        else:
+            source[col] = left.astype(str)
+            target[col] = right.astype(str)
+    return source, target
+
+def key_fingerprints(df:pandas.DataFrame,key_cols:list)->numpy.ndarray:
+    """
+    uint64 hash of the key columns with their dtypes, see 
+    align_key_dtypes to compare keys of two frames.
+    """
+    return pandas.util.hash_pandas_object(
+        df[key_cols],
+        index=False).values
+
+def match_keys(df:pandas.DataFrame,snapshot:pandas.DataFrame,key_cols:list,hash_column:str):
+    """
+    Look the keys of df up in a non empty snapshot with a sorted search.
+
+    Returns (found mask over df, stored hash text for every df row,
+    snapshot key hashes, df key hashes).
+    """
+    source, target = align_key_dtypes(df,snapshot,key_cols)
+    source_keys = key_fingerprints(source,key_cols)
+    target_keys = key_fingerprints(target,key_cols)
+    order = numpy.argsort(target_keys,kind='stable')
+    sorted_keys = target_keys[order]
+    positions = numpy.minimum(
+        numpy.searchsorted(sorted_keys,source_keys),
+        len(sorted_keys)-1)
+    found = sorted_keys[positions] == source_keys
+    target_hashes = snapshot[hash_column].astype(str).values[order][positions]
+    return found, target_hashes, target_keys, source_keys
+
+def unchanged_rows(
+    df:pandas.DataFrame,
+    hashes:pandas.Series,
+    snapshot:pandas.DataFrame,
+    key_cols:list,
+    hash_column:str)->numpy.ndarray:
+    """
+    Boolean mask of the rows of df whose key is in snapshot with the 
+    same hash.
+    """
+    if snapshot is None or snapshot.empty:
+        return numpy.zeros(len(df),dtype=bool)
+    found, target_hashes, _, _ = match_keys(df,snapshot,key_cols,hash_column)
+    return found & (target_hashes == numpy.asarray(hashes.values))
+
+def compute_deltas(
+    df:pandas.DataFrame,
+    snapshot:pandas.DataFrame,
+    key_cols:list,
+    hash_column:str,
+    ignore_fields=())->dict:
+    """
+    Change set between a source extract and a snapshot of the target 
+    keys and row hashes.
+
+    Keys are hashed and matched with a sorted search over numpy arrays.
+    Returns {'insert','update','delete'} dataframes, insert and update
+    rows carry their new hash in hash_column, delete only has the keys.
+    """
+    df = df.reset_index(drop=True)
+    hashes = fingerprint_to_text(
+        row_fingerprints(df,list(ignore_fields) + [hash_column])).values
+    df = df.assign(**{hash_column:hashes})
+    if snapshot is None or snapshot.empty:
+        return {
+            'insert':df,
+            'update':df.iloc[0:0],
+            'delete':pandas.DataFrame(columns=key_cols)
+        }
+    found, target_hashes, target_keys, source_keys = match_keys(
+        df,
+        snapshot,
+        key_cols,
+        hash_column)
+    changed = found & (target_hashes != hashes)
+
+    deleted = ~numpy.isin(target_keys,source_keys)
+    return {
+        'insert':df[~found],
+        'update':df[changed],
+        'delete':snapshot.loc[deleted,key_cols].reset_index(drop=True)
+    }
+
+def merge_snapshot(
+    snapshot:pandas.DataFrame,
+    df:pandas.DataFrame,
+    key_cols:list,
+    hash_column:str)->pandas.DataFrame:
+    """
+    Snapshot with the keys and hashes of the rows of df written to the
+    target, replacing the stored entries of the same keys.
+    """
+    written = df[key_cols + [hash_column]].drop_duplicates(key_cols,keep='last')
+    if snapshot is None or snapshot.empty:
+        return written.reset_index(drop=True)
+    target, source = align_key_dtypes(snapshot,written,key_cols)
+    replaced = numpy.isin(
+        key_fingerprints(target,key_cols),
+        key_fingerprints(source,key_cols))
+    return pandas.concat([snapshot[~replaced],written],ignore_index=True)
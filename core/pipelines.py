@@ -1,3 +1,4 @@
+import asyncio
 from datetime import datetime
 import logging
 import os
@@ -6,18 +7,29 @@ import time
 from typing import Union, TextIO
 import yaml
 from .exceptions import PipelineConfigException
+from .chunk_store import ChunkStore
+from .state import WatermarkStore
+from .profiling import StageProfiler
 from .sources import (
+    AsyncPipelineSourceDatabase,
     PipelineSource,
     PipelineSourceDatabase,
     PipelineSourceApi,
     PipelineSourceFlatFile
 )
 from .targets import (
+    AsyncPipelineTargetDatabase,
     PipelineTarget,
     PipelineTargetApi,
     PipelineTargetDatabase,
     PipelineTargetFlatFile
     )
+from borderliner.db.async_lib import close_pools
+from borderliner.db.instrumentation import (
+    QueryInstrumentation,
+    install_instrumentation,
+    uninstall_instrumentation
+)
 from borderliner.cloud import CloudEnvironment
 from borderliner.cloud.Aws import AwsEnvironment
 
@@ -39,6 +51,9 @@ class PipelineConfig:
     def __init__(self,
                 source:Union[str, TextIO],
                 ) -> None:
+        # INCREMENTAL: extract from the stored watermark and upsert
+        # DELTA: full extract diffed against the target keys, applied as
+        # inserts, updates and deletes
         self.pipeline_method = 'INCREMENTAL'
         self.perform_updates = False
         self.transform_data = False
@@ -57,6 +72,23 @@ class PipelineConfig:
         self.target = {}
         self.csv_filename_prefix = ''
         self.dump_data_csv = False
+        # csv, parquet or feather (Arrow IPC)
+        self.dump_format = 'csv'
+        # None uses snappy for parquet and lz4 for feather, 'none' 
+        # writes them uncompressed
+        self.dump_compression = None
+        # memory kept for dumped chunks handed from source to target in
+        # BATCH mode, 0 disables the chunk store and the target reads 
+        # dumps back. With the store the source keeps no chunks, 
+        # transform is called with an empty list
+        self.chunk_cache_mb = 0
+        # BATCH: extract everything, then transform, then load
+        # STREAM: extract, transform and load one chunk at a time
+        # OVERLAP: like STREAM, extracting the next chunk while the 
+        # current one is loaded
+        self.execution_mode = 'BATCH'
+        # chunks waiting between extract and load in OVERLAP mode
+        self.queue_size = 2
         
 
         self.md5_ignore_fields = []
@@ -64,6 +96,26 @@ class PipelineConfig:
         self.storage = {}
         # clear dump files after action
         self.clear_dumps = False
+        # sqlite file keeping the watermarks of INCREMENTAL pipelines
+        self.state_store = 'borderliner_state.db'
+        # per statement query statistics, exported at the end of the
+        # run to query_stats_file as json or prometheus (textfile)
+        self.query_stats_file = None
+        self.query_stats_format = 'json'
+        # fraction of the queries recording the caller stack
+        self.query_stats_stack_sample_rate = 0.0
+        self.query_stats_max_fingerprints = 500
+        # stages (extract, transform, dump, upload, load) run under 
+        # profile_mode (cprofile or tracemalloc), output in profile_dir
+        self.profile_stages = []
+        self.profile_mode = 'cprofile'
+        self.profile_dir = None
+        # database sources and targets on asyncio (asyncpg), run the
+        # pipeline with run_async to share one event loop
+        self.async_io = False
+        # pipeline_name of the pipelines that must succeed before this 
+        # one, used by the runner
+        self.depends_on = []
 
         try:
             f = open(source,'r+')
@@ -140,13 +192,28 @@ class Pipeline:
         
         self.source:PipelineSource = None
         self.target:PipelineTarget = None
+        self.metrics:dict = {}
+        self.chunk_store:ChunkStore = None
+        self.watermark_store:WatermarkStore = None
+        self.query_instrumentation:QueryInstrumentation = None
+        self.profiler = StageProfiler(
+            self.config.profile_stages,
+            self.config.profile_mode,
+            self.config.profile_dir,
+            prefix=f'{self.config.pipeline_name or "pipeline"}_{self.pid}')
         
         self._configure_pipeline(kwargs)
+        self._configure_instrumentation()
 
         self.logger.info(f'{str(self.__class__)} loaded.')
 
     def _configure_pipeline(self,*args,**kwargs):
-        
+        # deltas diff the whole extract, async pipelines extract it too
+        if str(self.config.pipeline_method).upper() == 'DELTA' \
+            and str(self.config.execution_mode).upper() != 'BATCH' \
+            and not self.config.async_io:
+            raise ValueError('DELTA pipelines need the BATCH execution_mode')
+
         if not kwargs.get('no_source',None):
             self.make_source()
 
@@ -154,6 +221,32 @@ class Pipeline:
             self.make_target()
         
         self._configure_environment(self.config['cloud'])
+        if self.target is not None:
+            self.target.set_environment(self.env)
+
+    def _configure_instrumentation(self):
+        if not self.config.query_stats_file:
+            return
+        self.query_instrumentation = QueryInstrumentation(
+            stack_sample_rate=self.config.query_stats_stack_sample_rate,
+            max_fingerprints=self.config.query_stats_max_fingerprints)
+        install_instrumentation(
+            self.query_instrumentation,
+            [getattr(self.source,'engine',None),getattr(self.target,'engine',None)])
+
+    def export_query_stats(self):
+        """
+        Write the query statistics of the run and stop recording.
+        """
+        if self.query_instrumentation is None:
+            return
+        uninstall_instrumentation(self.query_instrumentation)
+        self.metrics['queries'] = self.query_instrumentation.count
+        self.metrics['query_seconds'] = self.query_instrumentation.total_time
+        self.query_instrumentation.export(
+            self.config.query_stats_file,
+            self.config.query_stats_format,
+            self.config.pipeline_name)
 
     def _configure_environment(self,config:dict):
         service = config.get('service',None)
@@ -166,14 +259,30 @@ class Pipeline:
         if src == None:
             src = self.config.source
 
+        # streaming modes hand chunks to the target directly
+        # DELTA diffs the whole extract, it keeps the chunks in the source
+        if self.config.dump_data_csv \
+            and float(self.config.chunk_cache_mb) > 0 \
+            and str(self.config.execution_mode).upper() == 'BATCH' \
+            and str(self.config.pipeline_method).upper() != 'DELTA':
+            self.chunk_store = ChunkStore(self.config.chunk_cache_mb)
+
         if isinstance(src,dict):
             match str(src['source_type']).upper():
                 case 'DATABASE':
-                    self.source = PipelineSourceDatabase(
+                    source_class = PipelineSourceDatabase
+                    if self.config.async_io:
+                        source_class = AsyncPipelineSourceDatabase
+                    self.source = source_class(
                         src,
                         dump_data_csv=self.config.dump_data_csv,
+                        dump_format=self.config.dump_format,
+                        dump_compression=self.config.dump_compression,
+                        chunk_store=self.chunk_store,
+                        profiler=self.profiler,
                         pipeline_pid=self.pid
                     )
+                    self._configure_watermark()
                     return
                 case 'FILE':
                     self.source = PipelineSourceFlatFile(src)
@@ -190,11 +299,16 @@ class Pipeline:
         if isinstance(tgt,dict):
             match str(tgt['target_type']).upper():
                 case 'DATABASE':
-                    self.target = PipelineTargetDatabase(
+                    target_class = PipelineTargetDatabase
+                    if self.config.async_io:
+                        target_class = AsyncPipelineTargetDatabase
+                    self.target = target_class(
                         tgt,
                         dump_data_csv=self.config.dump_data_csv,
                         pipeline_pid=self.pid,
-                        csv_chunks_files=self.source.csv_chunks_files)
+                        csv_chunks_files=self.source.csv_chunks_files,
+                        chunk_store=self.chunk_store,
+                        md5_ignore_fields=self.config.md5_ignore_fields)
                     return
                 case 'FILE':
                     self.target = PipelineTargetFlatFile(tgt)
@@ -204,19 +318,94 @@ class Pipeline:
                     return
         raise ValueError('Unknown data target')
 
+    def _configure_watermark(self):
+        """
+        Resume incremental sources from the watermark of the last 
+        successful run.
+        """
+        if str(self.config.pipeline_method).upper() != 'INCREMENTAL':
+            self.source.watermark_column = None
+            return
+        if not getattr(self.source,'watermark_column',None):
+            return
+        self.watermark_store = WatermarkStore(self.config.state_store)
+        watermark = self.watermark_store.get(
+            self.config.pipeline_name,
+            self.source.watermark_column)
+        if watermark is not None:
+            self.source.watermark = watermark
+        self.logger.info(
+            f'incremental extraction from {self.source.watermark_column} > {self.source.watermark}')
+
+    def finish_load(self):
+        """
+        Commit what the target still holds, then advance the watermark.
+        """
+        if self.target is not None:
+            self.target.flush()
+        self.commit_watermark()
+
+    def commit_watermark(self):
+        """
+        Persist the highest watermark extracted, only called once the 
+        data is loaded in the target.
+        """
+        if self.watermark_store is None or self.source.next_watermark is None:
+            return
+        self.watermark_store.set(
+            self.config.pipeline_name,
+            self.source.watermark_column,
+            self.source.next_watermark)
+        self.source.watermark = str(self.source.next_watermark)
+        self.metrics['watermark'] = self.source.watermark
+
     def find_entry_point(self,*args,**kwargs):
+        if self.config.async_io:
+            # async backends only work on an event loop
+            asyncio.run(self._run_async_and_close(*args,**kwargs))
+            return
         self.run()
         self.after_run()
 
     def run(self,*args,**kwargs):
         pass
 
+    async def arun(self,*args,**kwargs):
+        """
+        Async run, pipelines without async support run in a thread.
+        """
+        await asyncio.to_thread(self.run,*args,**kwargs)
+
+    async def run_async(self,*args,**kwargs):
+        """
+        Entry point for event loops driving many pipelines, e.g.
+        asyncio.gather(*(p.run_async() for p in pipelines)). Await 
+        borderliner.db.async_lib.close_pools() before the loop ends.
+        """
+        await self.arun(*args,**kwargs)
+        self.after_run()
+
+    async def _run_async_and_close(self,*args,**kwargs):
+        try:
+            await self.run_async(*args,**kwargs)
+        finally:
+            await close_pools()
+
     def after_run(self,*args,**kwargs):
+        if self.target is not None:
+            self.target.close()
+        if self.chunk_store is not None:
+            self.metrics.update(self.chunk_store.metrics)
+            self.chunk_store.clear()
+        self.export_query_stats()
+        self.metrics.update(self.profiler.finish())
         self.print_metrics()
 
     def print_metrics(self):
         for metric, value in self.target.metrics.items():
             self.logger.info(f"{metric.capitalize()}: {value}")
+        for metric, value in self.metrics.items():
+            self.logger.info(f"{metric.capitalize()}: {value}")
 
 
     def get_query(self,query:str='extract'):
@@ -0,0 +1,211 @@
+import contextvars
+import cProfile
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+# logging
+import logging
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format='[%(asctime)s] %(levelname)s - %(message)s'
+    )
+logger = logging.getLogger()
+
+# stages open in the current thread or task, the time of a nested 
+# stage is not counted in the enclosing one
+_open_stages = contextvars.ContextVar('borderliner_open_stages',default=())
+
+def peak_rss_mb()->float:
+    """
+    Peak resident memory of the whole process so far, None when unknown.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    if sys.platform == 'darwin':
+        return round(peak / 1024 / 1024,3)
+    return round(peak / 1024,3)
+
+class StageProfiler:
+    """
+    Timings, rows, bytes and chunk counts of the pipeline stages.
+
+    Stages listed in profile_stages also run under cProfile or
+    tracemalloc (profile_mode), the output is written to profile_dir
+    when the run finishes. Stages may run on several threads, a stage
+    nested in another (dump in extract) is only counted in its own.
+    """
+    def __init__(self,
+            profile_stages:list=None,
+            profile_mode:str='cprofile',
+            profile_dir:str=None,
+            prefix:str='pipeline'):
+        if isinstance(profile_stages,str):
+            profile_stages = [e.strip() for e in profile_stages.split(',')]
+        self.profile_stages = [str(e).lower() for e in profile_stages or []]
+        self.profile_mode = str(profile_mode).lower()
+        self.profile_dir = profile_dir or os.getcwd()
+        self.prefix = prefix
+        self.stages = {}
+        self._profiles = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def _stage(self,name:str)->dict:
+        return self.stages.setdefault(name,{
+            'seconds':0.0,
+            'rows':0,
+            'bytes':0,
+            'chunks':0
+        })
+
+    def add(self,name:str,seconds:float=0.0,rows:int=0,bytes:int=0,chunks:int=0):
+        with self._lock:
+            stage = self._stage(name)
+            stage['seconds'] += seconds
+            stage['rows'] += rows or 0
+            stage['bytes'] += bytes or 0
+            stage['chunks'] += chunks or 0
+
+    def _start_profile(self,name:str)->bool:
+        if name not in self.profile_stages:
+            return False
+        if self.profile_mode == 'tracemalloc':
+            if tracemalloc.is_tracing():
+                # nested in another traced stage
+                return False
+            tracemalloc.start()
+            return True
+        try:
+            self._profiles.setdefault(name,cProfile.Profile()).enable()
+        except ValueError:
+            # another profiler is active in this thread
+            return False
+        return True
+
+    def _stop_profile(self,name:str):
+        if self.profile_mode == 'tracemalloc':
+            current, peak = tracemalloc.get_traced_memory()
+            self._snapshots[name] = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            with self._lock:
+                stage = self._stage(name)
+                stage['traced_peak_mb'] = max(
+                    stage.get('traced_peak_mb',0.0),
+                    round(peak / 1024 / 1024,3))
+            return
+        self._profiles[name].disable()
+
+    @contextmanager
+    def stage(self,name:str,rows:int=0,bytes:int=0,chunks:int=1):
+        """
+        Time the enclosed block as one run of the stage. The yielded 
+        counters (rows, bytes, chunks) are added when the block exits.
+        """
+        counters = {'rows':rows,'bytes':bytes,'chunks':chunks}
+        # seconds spent in nested stages
+        frame = [0.0]
+        token = _open_stages.set(_open_stages.get() + (frame,))
+        rss_before = peak_rss_mb()
+        started = time.perf_counter()
+        profiling = self._start_profile(name)
+        try:
+            yield counters
+        finally:
+            if profiling:
+                self._stop_profile(name)
+            elapsed = time.perf_counter() - started
+            _open_stages.reset(token)
+            with self._lock:
+                nested = frame[0]
+                parents = _open_stages.get()
+                if parents:
+                    parents[-1][0] += elapsed
+            self.add(
+                name,
+                max(elapsed - nested,0.0),
+                counters['rows'],
+                counters['bytes'],
+                counters['chunks'])
+            rss_after = peak_rss_mb()
+            if rss_after is not None:
+                # growth of the process peak while the stage ran
+                with self._lock:
+                    stage = self._stage(name)
+                    stage['peak_rss_growth_mb'] = max(
+                        stage.get('peak_rss_growth_mb',0.0),
+                        round(rss_after - rss_before,3))
+
+    def iterate(self,name:str,iterable):
+        """
+        Yield from iterable timing every step as the stage, for
+        generators of dataframes.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name,chunks=0) as stage:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                stage['chunks'] += 1
+                stage['rows'] += len(item) if hasattr(item,'__len__') else 0
+            yield item
+
+    def write_profiles(self)->list:
+        """
+        Write the cProfile stats (.prof) or the top tracemalloc
+        allocations (.txt) of the profiled stages.
+        """
+        files = []
+        os.makedirs(self.profile_dir,exist_ok=True)
+        for name, profile in self._profiles.items():
+            filename = os.path.join(self.profile_dir,f'{self.prefix}_{name}.prof')
+            profile.dump_stats(filename)
+            files.append(filename)
+        for name, snapshot in self._snapshots.items():
+            filename = os.path.join(self.profile_dir,f'{self.prefix}_{name}_tracemalloc.txt')
+            with open(filename,'w') as f:
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write(str(stat)+'\n')
+            files.append(filename)
+        for filename in files:
+            logger.info(f'profile written to {filename}')
+        return files
+
+    def metrics(self)->dict:
+        """
+        Flat metrics of every stage: {stage}_seconds, _rows,
+        _rows_per_second, _bytes, _chunks, _peak_rss_growth_mb and the
+        peak memory of the whole process.
+        """
+        metrics = {}
+        with self._lock:
+            stages = {name:dict(stage) for name, stage in self.stages.items()}
+        for name, stage in stages.items():
+            for key, value in stage.items():
+                metrics[f'{name}_{key}'] = value
+            if stage['seconds'] > 0 and stage['rows']:
+                metrics[f'{name}_rows_per_second'] = round(
+                    stage['rows'] / stage['seconds'],1)
+            if stage['seconds'] > 0 and stage['bytes']:
+                metrics[f'{name}_mb_per_second'] = round(
+                    stage['bytes'] / 1024 / 1024 / stage['seconds'],3)
+        metrics['process_peak_rss_mb'] = peak_rss_mb()
+        return metrics
+
+    def finish(self)->dict:
+        if self.profile_stages:
+            self.write_profiles()
+        return self.metrics()
@@ -0,0 +1,336 @@
+"""
+Run a directory of pipeline configs as a DAG.
+
+Pipelines declare their upstream pipelines with depends_on (a list of
+pipeline_name). Independent pipelines run in parallel on worker
+processes, limited per database server and per database by the
+max_concurrency / max_connections of their source and target configs
+(or the limits given to the runner):
+
+    python -m borderliner.core.runner pipelines/ --workers 4 --report run.json
+"""
+import argparse
+import glob
+import importlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import yaml
+from .exceptions import PipelineConfigException
+
+# logging
+import logging
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format='[%(asctime)s] %(levelname)s - %(message)s'
+    )
+logger = logging.getLogger()
+
+DEFAULT_PIPELINE_CLASSES = {
+    'ETL_PIPELINE':'borderliner.core.etl:EtlPipeline',
+    'EXTRACT_PIPELINE':'borderliner.core.etl:EtlPipeline',
+    'PROCESS_PIPELINE':'borderliner.core.etl:EtlPipeline',
+}
+
+def _load_class(path:str):
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module),name)
+
+def _json_safe(metrics:dict)->dict:
+    return {
+        str(k):(v if isinstance(v,(int,float,str,bool,type(None))) else str(v))
+        for k,v in (metrics or {}).items()}
+
+def _run_pipeline_process(config_file:str,class_path:str)->dict:
+    """
+    Worker process entry point, runs one pipeline and returns its
+    timings and metrics.
+    """
+    started = time.time()
+    result = {'pid':os.getpid(),'started':started}
+    try:
+        pipeline = _load_class(class_path)(config_file)
+        pipeline.find_entry_point()
+        result['status'] = 'success'
+        metrics = dict(getattr(pipeline.target,'metrics',None) or {})
+        metrics.update(pipeline.metrics)
+        result['metrics'] = _json_safe(metrics)
+    except BaseException as e:
+        result['status'] = 'failed'
+        result['error'] = f'{e.__class__.__name__}: {e}'
+        result['traceback'] = traceback.format_exc()
+    result['finished'] = time.time()
+    return result
+
+class PipelineSpec:
+    """
+    What the runner needs from a pipeline config: its name, upstream
+    pipelines and the databases it connects to.
+    """
+    def __init__(self,config_file:str,data:dict):
+        self.config_file = config_file
+        self.name = str(data.get('pipeline_name','') or
+            os.path.splitext(os.path.basename(config_file))[0])
+        depends_on = data.get('depends_on',[]) or []
+        if isinstance(depends_on,str):
+            depends_on = [e.strip() for e in depends_on.split(',')]
+        self.depends_on = [str(e) for e in depends_on]
+        self.pipeline_type = str(data.get('pipeline_type','') or 'ETL_PIPELINE').upper()
+        # resource key -> (concurrency, connections) used while running
+        self.resources = {}
+        self.declared_limits = {}
+        for role in ('source','target'):
+            self._add_resources(data.get(role,{}) or {},role)
+
+    def _add_resources(self,config:dict,role:str):
+        host = config.get('host',None)
+        if not host:
+            return
+        host = f"{host}:{config.get('port','')}"
+        database = f"{host}/{config.get('database','')}"
+        connections = 1
+        if role == 'source':
+            connections = max(int(config.get('iterate_workers',1) or 1),1)
+        elif int(config.get('load_workers',1) or 1) > 1:
+            # one connection per load worker plus the target connection
+            connections = int(config['load_workers']) + 1
+        for key in (host,database):
+            _, used = self.resources.get(key,(0,0))
+            # a pipeline reading and writing the same database counts once
+            self.resources[key] = (1,used + connections)
+        limits = {
+            name:int(config[name]) for name in ('max_concurrency','max_connections')
+            if config.get(name,None) is not None}
+        if limits:
+            self.declared_limits[database] = limits
+        host_limits = {
+            name:int(config[f'host_{name}']) for name in ('max_concurrency','max_connections')
+            if config.get(f'host_{name}',None) is not None}
+        if host_limits:
+            self.declared_limits[host] = host_limits
+
+class PipelineRunner:
+    """
+    Runs pipeline configs in dependency order on max_workers processes.
+
+    limits maps 'host:port' or 'host:port/database' to
+    {'max_concurrency':n,'max_connections':n}, merged with the limits
+    declared in the source and target configs (the lowest wins).
+    Pipelines whose upstream failed are skipped.
+    """
+    def __init__(self,
+            configs,
+            max_workers:int=4,
+            limits:dict=None,
+            pipeline_classes:dict=None,
+            report_file:str=None):
+        if isinstance(configs,str):
+            configs = [configs]
+        self.config_files = []
+        for path in configs:
+            if os.path.isdir(path):
+                self.config_files += sorted(
+                    glob.glob(os.path.join(path,'*.yml'))
+                    + glob.glob(os.path.join(path,'*.yaml')))
+            else:
+                self.config_files.append(path)
+        self.max_workers = max(int(max_workers),1)
+        self.pipeline_classes = {**DEFAULT_PIPELINE_CLASSES,**(pipeline_classes or {})}
+        self.report_file = report_file
+        self.specs = {}
+        for config_file in self.config_files:
+            with open(config_file) as f:
+                spec = PipelineSpec(config_file,yaml.safe_load(f) or {})
+            if spec.name in self.specs:
+                raise PipelineConfigException(
+                    f'pipeline {spec.name} declared twice: '
+                    f'{self.specs[spec.name].config_file} and {config_file}')
+            self.specs[spec.name] = spec
+        self.limits = {}
+        for spec in self.specs.values():
+            for key, declared in spec.declared_limits.items():
+                self._merge_limits(key,declared)
+        for key, declared in (limits or {}).items():
+            self._merge_limits(key,declared)
+        self.order = self.topological_order()
+        self.results = {}
+
+    def _merge_limits(self,key:str,declared:dict):
+        current = self.limits.setdefault(key,{})
+        for name, value in declared.items():
+            current[name] = min(int(value),current.get(name,int(value)))
+
+    def topological_order(self)->list:
+        """
+        Pipeline names in dependency order, raises on unknown upstreams
+        and cycles.
+        """
+        for spec in self.specs.values():
+            unknown = [e for e in spec.depends_on if e not in self.specs]
+            if unknown:
+                raise PipelineConfigException(
+                    f'pipeline {spec.name} depends on unknown pipelines {unknown}')
+        remaining = {name:set(spec.depends_on) for name, spec in self.specs.items()}
+        order = []
+        while remaining:
+            ready = sorted(name for name, deps in remaining.items() if not deps)
+            if not ready:
+                raise PipelineConfigException(
+                    f'dependency cycle between {sorted(remaining)}')
+            for name in ready:
+                order.append(name)
+                remaining.pop(name)
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
+    def _fits(self,spec:PipelineSpec,usage:dict)->bool:
+        for key, (concurrency, connections) in spec.resources.items():
+            limits = self.limits.get(key,{})
+            used_concurrency, used_connections = usage.get(key,(0,0))
+            if not used_concurrency:
+                # a pipeline above the limits still runs alone
+                continue
+            if 'max_concurrency' in limits \
+                and used_concurrency + concurrency > limits['max_concurrency']:
+                return False
+            if 'max_connections' in limits \
+                and used_connections + connections > limits['max_connections']:
+                return False
+        return True
+
+    def _use(self,spec:PipelineSpec,usage:dict,sign:int):
+        for key, (concurrency, connections) in spec.resources.items():
+            used_concurrency, used_connections = usage.get(key,(0,0))
+            usage[key] = (
+                used_concurrency + sign*concurrency,
+                used_connections + sign*connections)
+
+    def run(self)->dict:
+        started = time.time()
+        pending = list(self.order)
+        running = {}
+        usage = {}
+        ready_since = {}
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name in list(pending):
+                    spec = self.specs[name]
+                    upstream = [self.results.get(e,{}).get('status') for e in spec.depends_on]
+                    if any(status in ('failed','skipped') for status in upstream):
+                        pending.remove(name)
+                        self.results[name] = {
+                            'status':'skipped',
+                            'error':'upstream pipeline failed'}
+                        logger.warning(f'{name} skipped, upstream failed')
+                        continue
+                    if not all(status == 'success' for status in upstream):
+                        continue
+                    ready_since.setdefault(name,time.time())
+                    if len(running) >= self.max_workers or not self._fits(spec,usage):
+                        continue
+                    class_path = self.pipeline_classes.get(
+                        spec.pipeline_type,
+                        DEFAULT_PIPELINE_CLASSES['ETL_PIPELINE'])
+                    future = executor.submit(
+                        _run_pipeline_process,
+                        spec.config_file,
+                        class_path)
+                    running[future] = name
+                    pending.remove(name)
+                    self._use(spec,usage,1)
+                    logger.info(f'{name} started')
+                if not running:
+                    if pending:
+                        raise PipelineConfigException(
+                            f'pipelines {pending} can not run within the limits {self.limits}')
+                    break
+                done, _ = wait(running,return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    self._use(self.specs[name],usage,-1)
+                    try:
+                        result = future.result()
+                    except BaseException as e:
+                        # worker process died
+                        result = {'status':'failed','error':str(e)}
+                    result['waited_seconds'] = round(
+                        result.get('started',time.time()) - ready_since[name],3)
+                    self.results[name] = result
+                    logger.info(f"{name} {result['status']}")
+        return self.report(started,time.time())
+
+    def report(self,started:float,finished:float)->dict:
+        """
+        Combined timings: wall time of the run, sum of the pipeline
+        times and each pipeline start offset and duration.
+        """
+        pipelines = []
+        for name in self.order:
+            result = dict(self.results.get(name,{}))
+            entry = {
+                'pipeline':name,
+                'depends_on':self.specs[name].depends_on,
+                'status':result.pop('status','not run')
+            }
+            if 'started' in result:
+                entry['start_offset_seconds'] = round(result.pop('started') - started,3)
+                entry['seconds'] = round(result.pop('finished') - started - entry['start_offset_seconds'],3)
+            entry.update(result)
+            pipelines.append(entry)
+        total = sum(e.get('seconds',0) for e in pipelines)
+        wall = finished - started
+        report = {
+            'wall_seconds':round(wall,3),
+            'pipeline_seconds':round(total,3),
+            'parallel_speedup':round(total / wall,2) if wall > 0 else None,
+            'workers':self.max_workers,
+            'limits':self.limits,
+            'failed':[e['pipeline'] for e in pipelines if e['status'] == 'failed'],
+            'skipped':[e['pipeline'] for e in pipelines if e['status'] == 'skipped'],
+            'pipelines':pipelines
+        }
+        for e in pipelines:
+            logger.info(
+                f"{e['pipeline']}: {e['status']} "
+                f"start +{e.get('start_offset_seconds','-')}s "
+                f"took {e.get('seconds','-')}s")
+        logger.info(
+            f"{len(pipelines)} pipelines in {report['wall_seconds']}s "
+            f"({report['pipeline_seconds']}s of pipeline time)")
+        if self.report_file:
+            with open(self.report_file,'w') as f:
+                json.dump(report,f,indent=2,default=str)
+        return report
+
+def _parse_limit(value:str):
+    # host:port[/database]=concurrency[,connections]
+    key, limit = value.rsplit('=',1)
+    limits = [int(e) for e in limit.split(',')]
+    parsed = {'max_concurrency':limits[0]}
+    if len(limits) > 1:
+        parsed['max_connections'] = limits[1]
+    return key, parsed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run pipeline configs as a DAG')
+    parser.add_argument('configs',nargs='+',help='config files or directories')
+    parser.add_argument('--workers',type=int,default=4)
+    parser.add_argument('--limit',action='append',default=[],
+        help='host:port[/database]=max_concurrency[,max_connections]')
+    parser.add_argument('--report',help='json timing report')
+    args = parser.parse_args(argv)
+    runner = PipelineRunner(
+        args.configs,
+        max_workers=args.workers,
+        limits=dict(_parse_limit(e) for e in args.limit),
+        report_file=args.report)
+    report = runner.run()
+    return 1 if report['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
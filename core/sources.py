@@ -1,10 +1,22 @@
+import numpy
 import pandas
 import logging
 import sys
+import asyncio
+import collections
+import datetime
+import decimal
+import os
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-from borderliner.db.conn_abstract import DatabaseBackend
+from .exceptions import PipelineConfigException, PipelineExtractionException
+from .dumps import dump_filename, write_dump
+from .fingerprints import compute_deltas
+from borderliner.db.conn_abstract import DatabaseBackend, get_registered_engine
 from borderliner.db.postgres_lib import PostgresBackend
 from borderliner.db.redshift_lib import RedshiftBackend
+from borderliner.db.async_lib import AsyncPostgresBackend
 # logging
 logging.basicConfig(
     stream=sys.stdout, 
@@ -13,6 +25,17 @@ logging.basicConfig(
     )
 logger = logging.getLogger()
 
+def _read_slice_in_process(uri,query):
+    """
+    Process pool entry point, engines can not be pickled so each worker
+    process opens its own.
+    """
+    engine = get_registered_engine(
+        uri,
+        connect_args={'sslmode': 'prefer'},
+        pool_size=1)
+    return pandas.read_sql_query(query,engine)
+
 class PipelineSource:
     def __init__(self,config:dict,*args,**kwargs) -> None:
         self.kwargs = kwargs
@@ -30,6 +53,19 @@ class PipelineSource:
     def extract(self):
         pass
 
+    def iter_chunks(self):
+        """
+        Yield the extracted data one dataframe at a time without keeping 
+        it in the source. Default implementation yields whatever 
+        extract loaded.
+        """
+        data = self.data
+        if isinstance(data,list):
+            for df in data:
+                yield df
+        elif data is not None:
+            yield data
+
     def __str__(self) -> str:
         return str(self.config)
 
@@ -79,6 +115,25 @@ class PipelineSourceDatabase(PipelineSource):
         self.iteration_list = []
         self.deltas = {}
         self.primary_key = ()
+        # concurrent extraction of the iterate slices
+        self.iterate_workers = 1
+        self.iterate_executor = 'thread'
+        self.failed_slices = []
+        # stream the extract query through a server side cursor
+        self.server_side_cursor = False
+        self.itersize = 10000
+        # incremental extraction, watermark is the value loaded by the
+        # last successful run and next_watermark the max extracted now
+        self.watermark_column = None
+        self.watermark = None
+        self.next_watermark = None
+        # range partitioned extraction: the extract query is split in
+        # split_count bounded queries on split_column (integer or 
+        # timestamp), bounds from min/max or quantiles (split_method)
+        self.split_column = None
+        self.split_count = 1
+        self.split_method = 'minmax'
+        self.split_ordered = True
 
         self.configure()
     
@@ -87,109 +142,437 @@ class PipelineSourceDatabase(PipelineSource):
         self.password = self.config['password']
         self.host = self.config['host']
         self.port = self.config['port']
+        # engine pool and connection reuse settings
+        pool_options = {
+            key:self.config[key] for key in (
+                'pool_size',
+                'max_overflow',
+                'pool_pre_ping',
+                'pool_recycle',
+                'reuse_connections')
+            if key in self.config
+        }
+        self.backend = self.make_backend(pool_options)
+        self.queries = self.config['queries']
+        self.chunk_size = int(self.config.get('chunk_size',-1))
+        self.iterate_workers = int(self.config.get('iterate_workers',1))
+        self.iterate_executor = str(
+            self.config.get('iterate_executor','thread')).lower()
+        self.server_side_cursor = bool(
+            self.config.get('server_side_cursor',False))
+        self.itersize = int(self.config.get('itersize',10000))
+        self.primary_key = tuple(self.config.get('primary_key',()) or ())
+        self.watermark_column = self.config.get('watermark_column',None)
+        # None extracts every row until a watermark is stored
+        self.watermark = self.config.get('watermark_initial',None)
+        self.split_column = self.config.get('split_column',None)
+        if self.split_column and 'iterate' in self.queries:
+            raise PipelineConfigException(
+                'split_column and an iterate query can not be used together')
+        self.split_count = int(
+            self.config.get('split_count',max(self.iterate_workers,1)))
+        self.split_method = str(self.config.get('split_method','minmax')).lower()
+        self.split_ordered = bool(self.config.get('split_ordered',True))
+        self.engine = self.make_engine()
+
+    def make_backend(self,pool_options:dict)->DatabaseBackend:
         match str(self.config['type']).upper():
             case 'POSTGRES':
-                self.backend = PostgresBackend(
+                return PostgresBackend(
                     host=self.host,
                     database=self.config['database'],
                     user=self.user,
                     password=self.password,
-                    port=self.port
+                    port=self.port,
+                    **pool_options
                 )
             case 'REDSHIFT':
-                self.backend = RedshiftBackend(
+                return RedshiftBackend(
                     host=self.host,
                     database=self.config['database'],
                     user=self.user,
                     password=self.password,
-                    port=self.port
+                    port=self.port,
+                    **pool_options
                 )
-        self.queries = self.config['queries']
-        self.engine = self.backend.get_engine()
-        self.connection = self.backend.get_connection()
+
+    def make_engine(self):
+        engine_args = {}
+        if self.iterate_workers > 1:
+            # one pooled connection per worker thread
+            engine_args['pool_size'] = self.iterate_workers
+        return self.backend.get_engine(**engine_args)
     
-    def populate_deltas(self):
-        pass
+    def populate_deltas(
+        self,
+        snapshot:pandas.DataFrame,
+        hash_column:str,
+        primary_key=None,
+        ignore_fields=()):
+        """
+        Compute the insert/update/delete change set between the 
+        extracted data and a target snapshot of keys and row hashes.
 
-    def populate_iteration_list(self):
+        The result is kept in deltas as {'insert','update','delete'} 
+        dataframes.
+        """
+        key_cols = list(primary_key or self.primary_key)
+        if not key_cols:
+            raise ValueError('primary_key is required to compute deltas')
+        data = self.data
+        if isinstance(data,list):
+            data = pandas.concat(data,ignore_index=True) if data \
+                else pandas.DataFrame()
+        self.deltas = compute_deltas(
+            data,
+            snapshot,
+            key_cols,
+            hash_column,
+            ignore_fields)
+        self.logger.info(
+            f"deltas: {len(self.deltas['insert'])} inserts, "
+            f"{len(self.deltas['update'])} updates, "
+            f"{len(self.deltas['delete'])} deletes")
+        return self.deltas
+
+    def dump_chunk(self,df:pandas.DataFrame,slice_index)->str:
+        """
+        Write df to the dump of slice_index when dump_data_csv is on,
+        using the pipeline dump_format (csv by default).
+        """
+        if not self.kwargs.get('dump_data_csv',False):
+            return None
+        if isinstance(slice_index,int):
+            slice_index = str(slice_index).zfill(5)
+        dump_format = self.kwargs.get('dump_format','csv')
+        filename = dump_filename(slice_index,self.pipeline_pid,dump_format)
+        profiler = self.kwargs.get('profiler',None)
+        with profiler.stage('dump',rows=len(df)) if profiler else nullcontext({}) as stage:
+            write_dump(
+                df,
+                filename,
+                dump_format,
+                self.kwargs.get('dump_compression',None))
+            stage['bytes'] = stage.get('bytes',0) + os.path.getsize(filename)
+        self.csv_chunks_files.append(filename)
+        chunk_store = self.kwargs.get('chunk_store',None)
+        if chunk_store is not None:
+            chunk_store.put(filename,df,path=filename)
+        return filename
+
+    def get_iteration_items(self)->list:
+        """
+        Rows of the iterate query as dicts of strings, used to format 
+        the extract query of every slice.
+        """
         df = pandas.read_sql_query(
             self.queries['iterate'],
             self.engine
         )
         
-        total_cols = int(df.shape[1])
-        self._data = []
         for col in df.columns:
             df[col] = df[col].astype(str)
         
-        df = df.to_dict(orient='records')
+        return df.to_dict(orient='records')
+
+    def _split_literal(self,value)->str:
+        if isinstance(value,datetime.datetime):
+            value = pandas.Timestamp(value)
+        if isinstance(value,(int,float,decimal.Decimal,numpy.integer,numpy.floating)):
+            return str(value)
+        if isinstance(value,pandas.Timestamp):
+            if value.tz is not None:
+                return f"'{value.isoformat()}'::timestamptz"
+            return f"'{value.isoformat()}'::timestamp"
+        if isinstance(value,datetime.date):
+            return f"'{value.isoformat()}'::date"
+        raise PipelineConfigException(
+            f'split_column {self.split_column} must be numeric or temporal, '
+            f'got {type(value).__name__} bounds')
+
+    def get_split_bounds(self)->list:
+        """
+        Sorted distinct bounds of split_column in the extract result:
+        min and max with split_count - 1 values in between, evenly 
+        spaced (minmax) or at the quantiles of the column (quantiles, 
+        for skewed distributions).
+        """
+        column = self.split_column
+        source = f"({self.get_query('extract')}) AS borderliner_split"
+        if self.split_method == 'quantiles' and self.split_count > 1:
+            percentiles = ','.join(
+                f'PERCENTILE_DISC({i / self.split_count}) WITHIN GROUP (ORDER BY {column}) AS q{i}'
+                for i in range(1,self.split_count))
+            query = f'SELECT MIN({column}), {percentiles}, MAX({column}) FROM {source}'
+            bounds = pandas.read_sql_query(
+                query,self.engine,coerce_float=False).iloc[0].tolist()
+        else:
+            # numerics stay decimals, floats would round the bounds
+            low, high = pandas.read_sql_query(
+                f'SELECT MIN({column}), MAX({column}) FROM {source}',
+                self.engine,
+                coerce_float=False).iloc[0].tolist()
+            if low is None or pandas.isna(low):
+                return []
+            # text bounds would be interpolated in the sql
+            self._split_literal(low)
+            if isinstance(low,(int,numpy.integer)):
+                bounds = numpy.unique(numpy.linspace(
+                    int(low),int(high),self.split_count + 1).round().astype('int64')).tolist()
+            elif isinstance(low,decimal.Decimal):
+                step = (high - low) / self.split_count
+                bounds = [low + step*i for i in range(self.split_count)] + [high]
+            elif isinstance(low,(float,numpy.floating)):
+                bounds = numpy.linspace(low,high,self.split_count + 1).tolist()
+            else:
+                low, high = pandas.Timestamp(low), pandas.Timestamp(high)
+                bounds = [
+                    pandas.Timestamp(int(e),tz=low.tz) for e in numpy.linspace(
+                        low.value,high.value,self.split_count + 1)]
+        bounds = [e for e in bounds if e is not None and not pandas.isna(e)]
+        return sorted(set(bounds))
+
+    def get_split_items(self)->list:
+        """
+        Range conditions on split_column covering the extract result,
+        nulls included, one item per sub-query. The first and last 
+        ranges are open ended so no row depends on the min and max.
+        """
+        column = self.split_column
+        cuts = [self._split_literal(e) for e in self.get_split_bounds()[1:-1]]
+        items = []
+        if not cuts:
+            items.append({'split':f'{column} IS NOT NULL'})
+        else:
+            items.append({'split':f'{column} < {cuts[0]}'})
+            for low, high in zip(cuts,cuts[1:]):
+                items.append({'split':f'{column} >= {low} AND {column} < {high}'})
+            items.append({'split':f'{column} >= {cuts[-1]}'})
+        items.append({'split':f'{column} IS NULL'})
+        return items
+
+    def slice_query(self,item:dict)->str:
+        """
+        Query of one iteration item: the extract query formatted with 
+        the item or, for range splits, bounded by the item condition.
+        """
+        if 'split' in item:
+            return f"SELECT * FROM ({self.get_query('extract')}) AS borderliner_split " \
+                f"WHERE {item['split']}"
+        return self.queries['extract'].format(
+            **{**self.get_watermark_params(),**item}
+        )
+
+    def iter_split_ranges(self):
+        """
+        Run the range splits of the extract query on iterate_workers,
+        in range order or as they finish (split_ordered: false).
+        """
+        items = self.get_split_items()
+        self.logger.info(
+            f'extract split in {len(items)} ranges of {self.split_column}')
+        for data in self.iter_iteration_list(items,ordered=self.split_ordered):
+            self.metrics['total_rows'] += len(data)
+            self.track_watermark(data)
+            yield data
+
+    def iter_iteration_list(self,items:list=None,ordered:bool=True):
+        """
+        Run the extract query once per row of the iterate query (or per
+        item given), yielding each slice.
+        """
+        if items is None:
+            items = self.get_iteration_items()
+        if self.iterate_workers > 1:
+            yield from self.iter_iteration_list_concurrent(items,ordered)
+            return
         slice_index = 1
-        for item in df:
+        for item in items:
             self.logger.info(f'Extract by iteration: {item}')
-            query = self.queries['extract'].format(
-                **item
-            )
-            data = pandas.read_sql_query(query,self.engine)
-            if self.kwargs.get('dump_data_csv',False):
-                filename = f'slice_{str(slice_index).zfill(5)}_{self.pipeline_pid}.csv'                
-                data.to_csv(
-                    filename,
-                    header=True,
-                    index=False
-                )
-                self.csv_chunks_files.append(filename)
-                self._data.append(data)
-            else:
-                self._data.append(data)
+            data = pandas.read_sql_query(self.slice_query(item),self.engine)
+            self.dump_chunk(data,slice_index)
             slice_index += 1
-        
+            yield data
+
+    def _submit_slice(self,executor,item):
+        query = self.slice_query(item)
+        if self.iterate_executor == 'process':
+            return executor.submit(
+                _read_slice_in_process,
+                self.backend.uri,
+                query)
+        return executor.submit(pandas.read_sql_query,query,self.engine)
+
+    def _collect_slice(self,slice_index,item,future):
+        try:
+            data = future.result()
+        except Exception as e:
+            self.logger.error(f'Extract by iteration failed: {item} {e}')
+            self.failed_slices.append((slice_index,item,str(e)))
+            return
+        self.logger.info(f'Extract by iteration: {item}')
+        self.dump_chunk(data,slice_index)
+        yield data
+
+    def iter_iteration_list_concurrent(self,items:list=None,ordered:bool=True):
+        """
+        Run the slices on iterate_workers threads (or processes with 
+        iterate_executor: process). Slices are yielded and dumped in 
+        iteration order, or as they finish when ordered is False. Failed 
+        slices are collected in failed_slices and reported once every 
+        other slice is done.
+        """
+        match self.iterate_executor:
+            case 'process':
+                executor_class = ProcessPoolExecutor
+            case 'thread':
+                executor_class = ThreadPoolExecutor
+            case _:
+                raise ValueError(
+                    f'Unknown iterate_executor {self.iterate_executor}')
+        if items is None:
+            items = self.get_iteration_items()
+        self.failed_slices = []
+        pending = collections.deque()
+        with executor_class(max_workers=self.iterate_workers) as executor:
+            for slice_index, item in enumerate(items,start=1):
+                pending.append(
+                    (slice_index,item,self._submit_slice(executor,item)))
+                # keep a bounded number of finished slices in memory
+                if len(pending) >= self.iterate_workers*2:
+                    yield from self._collect_next_slice(pending,ordered)
+            while pending:
+                yield from self._collect_next_slice(pending,ordered)
+        if self.failed_slices:
+            raise PipelineExtractionException(
+                f'{len(self.failed_slices)} slices failed: '
+                f'{[s[1] for s in self.failed_slices]}')
+
+    def _collect_next_slice(self,pending:collections.deque,ordered:bool):
+        if ordered:
+            yield from self._collect_slice(*pending.popleft())
+            return
+        wait([e[2] for e in pending],return_when=FIRST_COMPLETED)
+        for entry in [e for e in pending if e[2].done()]:
+            pending.remove(entry)
+            yield from self._collect_slice(*entry)
+
+    def populate_iteration_list(self):
+        self._data = []
+        for data in self.iter_iteration_list():
+            self.track_watermark(data)
+            self._data.append(data)
 
     def extract_by_iteration(self):
         self.populate_iteration_list()
 
-    def extract(self):
+    def iter_chunks(self):
+        """
+        Yield the extraction one dataframe at a time: one per iteration
+        row, one per chunk_size rows or the full result. Nothing is kept
+        in the source so memory is bounded by the chunk size.
+        """
         if 'iterate' in self.queries:
-            self.extract_by_iteration()
+            for data in self.iter_iteration_list():
+                self.metrics['total_rows'] += len(data)
+                self.track_watermark(data)
+                yield data
             return
-        if self.chunk_size > 0: 
-            data = pandas.read_sql_query(
-                self.get_query('extract'),
-                self.engine,
-                chunksize=self.chunk_size)
+        if self.split_column:
+            yield from self.iter_split_ranges()
+            return
+        if self.server_side_cursor or self.chunk_size > 0:
+            if self.server_side_cursor:
+                data = self.backend.iter_query(
+                    self.engine,
+                    self.get_query('extract'),
+                    chunk_size=self.chunk_size if self.chunk_size > 0 else self.itersize,
+                    itersize=self.itersize)
+            else:
+                data = pandas.read_sql_query(
+                    self.get_query('extract'),
+                    self.engine,
+                    chunksize=self.chunk_size)
             slice_index = 1
             for df in data:
-                if self.kwargs.get('dump_data_csv',False):
-                    filename = f'slice_{str(slice_index).zfill(5)}_{self.pipeline_pid}.csv'                
-                    df.to_csv(
-                        filename,
-                        header=True,
-                        index=False
-                    )
-                    self.csv_chunks_files.append(filename)
-                    slice_index += 1
-            self._data = data
+                self.dump_chunk(df,slice_index)
+                slice_index += 1
+                self.metrics['total_rows'] += len(df)
+                self.track_watermark(df)
+                yield df
         else:
             data = pandas.read_sql_query(
                 self.get_query('extract'),
                 self.engine)
-            if self.kwargs.get('dump_data_csv',False):
-                filename = f'slice_FULL_{self.pipeline_pid}.csv'                
-                data.to_csv(
-                    filename,
-                    header=True,
-                    index=False
-                )
-                self.csv_chunks_files.append(filename)
-            self._data = data
+            self.dump_chunk(data,'FULL')
+            self.metrics['total_rows'] += len(data)
+            self.track_watermark(data)
+            yield data
+
+    def extract(self):
+        if self.kwargs.get('chunk_store',None) is not None \
+            and self.kwargs.get('dump_data_csv',False):
+            # the chunk store owns the dumped chunks, the target reads
+            # them back by dump file
+            for df in self.iter_chunks():
+                pass
+            self._data = []
+            return
+        if 'iterate' in self.queries:
+            self.extract_by_iteration()
+            return
+        if self.chunk_size > 0 or self.server_side_cursor or self.split_column:
+            self._data = list(self.iter_chunks())
+        else:
+            self._data = next(self.iter_chunks())
             
 
+    def get_watermark_params(self)->dict:
+        """
+        Parameters injected in the extract query in incremental mode.
+
+        {watermark_filter} renders watermark_column > watermark, or a 
+        predicate matching every row when no watermark is known yet. 
+        {watermark} is the raw value and needs watermark_initial for the
+        first run.
+        """
+        if not self.watermark_column:
+            return {}
+        if self.watermark is None:
+            if '{watermark}' in str(self.queries.get('extract','')):
+                raise PipelineConfigException(
+                    f'no watermark stored for {self.watermark_column}: set '
+                    'watermark_initial or filter with {watermark_filter}')
+            return {'watermark_filter':'1=1'}
+        # an untyped literal is cast to the column type (integer, date...)
+        literal = "'" + str(self.watermark).replace("'","''") + "'"
+        return {
+            'watermark':self.watermark,
+            'watermark_filter':f'{self.watermark_column} > {literal}'
+        }
+
+    def track_watermark(self,df:pandas.DataFrame):
+        if not self.watermark_column or df.empty:
+            return
+        if self.watermark_column not in df.columns:
+            raise ValueError(
+                f'watermark column {self.watermark_column} not extracted')
+        value = df[self.watermark_column].max()
+        if pandas.isna(value):
+            return
+        if self.next_watermark is None or value > self.next_watermark:
+            self.next_watermark = value
+
     def get_query(self,query:str='extract'):
         print(self.queries)
         if query in self.queries:
             key_params = str(query)+'_params'
-            if key_params in self.queries:
+            params = dict(self.queries.get(key_params,{}) or {})
+            if query == 'extract':
+                params.update(self.get_watermark_params())
+            if params:
                 return self.queries[query].format(
-                    **self.queries[key_params]
+                    **params
                 )
             else:
                 return self.queries[query]
@@ -201,6 +584,114 @@ class PipelineSourceDatabase(PipelineSource):
 
 
 
+class AsyncPipelineSourceDatabase(PipelineSourceDatabase):
+    """
+    Postgres source read through asyncpg, for pipelines driven by an
+    event loop. No sync engine is created.
+    """
+    def make_backend(self,pool_options:dict)->DatabaseBackend:
+        if str(self.config['type']).upper() != 'POSTGRES':
+            raise ValueError('async sources support POSTGRES only')
+        return AsyncPostgresBackend(
+            host=self.host,
+            database=self.config['database'],
+            user=self.user,
+            password=self.password,
+            port=self.port,
+            **{key:self.config[key] for key in (
+                'pool_size',
+                'max_overflow',
+                'pool_min_size')
+            if key in self.config}
+        )
+
+    def make_engine(self):
+        return None
+
+    async def _read_slice(self,semaphore,item):
+        query = self.queries['extract'].format(
+            **{**self.get_watermark_params(),**item}
+        )
+        async with semaphore:
+            return await self.backend.fetch_frame(query)
+
+    async def aiter_iteration_list(self):
+        """
+        Run the extract query once per row of the iterate query, at most
+        iterate_workers at a time and 2*iterate_workers slices ahead, 
+        yielding the slices in order. Failed slices are collected in
+        failed_slices and reported once every other slice is done.
+        """
+        items = (await self.backend.fetch_frame(self.queries['iterate'])).astype(str)
+        remaining = collections.deque(
+            enumerate(items.to_dict(orient='records'),start=1))
+        workers = max(self.iterate_workers,1)
+        semaphore = asyncio.Semaphore(workers)
+        self.failed_slices = []
+        pending = collections.deque()
+        try:
+            while remaining or pending:
+                # keep a bounded number of finished slices in memory
+                while remaining and len(pending) < workers*2:
+                    slice_index, item = remaining.popleft()
+                    pending.append((
+                        slice_index,
+                        item,
+                        asyncio.ensure_future(self._read_slice(semaphore,item))))
+                slice_index, item, task = pending.popleft()
+                try:
+                    data = await task
+                except Exception as e:
+                    self.logger.error(f'Extract by iteration failed: {item} {e}')
+                    self.failed_slices.append((slice_index,item,str(e)))
+                    continue
+                self.logger.info(f'Extract by iteration: {item}')
+                await asyncio.to_thread(self.dump_chunk,data,slice_index)
+                yield data
+        finally:
+            for _, _, task in pending:
+                task.cancel()
+        if self.failed_slices:
+            raise PipelineExtractionException(
+                f'{len(self.failed_slices)} slices failed: '
+                f'{[s[1] for s in self.failed_slices]}')
+
+    async def aiter_chunks(self):
+        """
+        Async iter_chunks: one dataframe per iteration row, per 
+        chunk_size rows or the full result.
+        """
+        if 'iterate' in self.queries:
+            data = self.aiter_iteration_list()
+        elif self.server_side_cursor or self.chunk_size > 0:
+            data = self.backend.iter_query(
+                self.get_query('extract'),
+                chunk_size=self.chunk_size if self.chunk_size > 0 else self.itersize,
+                prefetch=self.itersize)
+        else:
+            df = await self.backend.fetch_frame(self.get_query('extract'))
+            await asyncio.to_thread(self.dump_chunk,df,'FULL')
+            self.metrics['total_rows'] += len(df)
+            self.track_watermark(df)
+            yield df
+            return
+        slice_index = 1
+        async for df in data:
+            if 'iterate' not in self.queries:
+                await asyncio.to_thread(self.dump_chunk,df,slice_index)
+            slice_index += 1
+            self.metrics['total_rows'] += len(df)
+            self.track_watermark(df)
+            yield df
+
+    async def aextract(self):
+        chunks = [df async for df in self.aiter_chunks()]
+        if 'iterate' in self.queries or self.chunk_size > 0 or self.server_side_cursor:
+            self._data = chunks
+        else:
+            self._data = chunks[0]
+        return self._data
+
 class PipelineSourceApi(PipelineSource):
     pass
 
@@ -0,0 +1,43 @@
+from contextlib import closing
+from datetime import datetime
+import sqlite3
+
+class WatermarkStore:
+    """
+    Local sqlite store of the high watermark reached by every pipeline
+    running in INCREMENTAL mode.
+    """
+    def __init__(self,path:str='borderliner_state.db') -> None:
+        self.path = path
+        with closing(sqlite3.connect(self.path)) as conn:
+            with conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS watermarks (
+                        pipeline_name TEXT NOT NULL,
+                        column_name TEXT NOT NULL,
+                        value TEXT,
+                        updated_at TEXT,
+                        PRIMARY KEY (pipeline_name, column_name)
+                    )""")
+
+    def get(self,pipeline_name:str,column_name:str):
+        with closing(sqlite3.connect(self.path)) as conn:
+            row = conn.execute(
+                "SELECT value FROM watermarks "
+                "WHERE pipeline_name = ? AND column_name = ?",
+                (pipeline_name,column_name)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set(self,pipeline_name:str,column_name:str,value):
+        with closing(sqlite3.connect(self.path)) as conn:
+            with conn:
+                conn.execute(
+                    "INSERT INTO watermarks "
+                    "(pipeline_name, column_name, value, updated_at) "
+                    "VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (pipeline_name, column_name) DO UPDATE SET "
+                    "value = excluded.value, updated_at = excluded.updated_at",
+                    (pipeline_name,column_name,str(value),
+                     datetime.now().isoformat()))
@@ -1,11 +1,21 @@
 
+import asyncio
 import pandas
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
+from .dumps import read_dump
+from .fingerprints import (
+    row_fingerprints,
+    fingerprint_to_text,
+    merge_snapshot,
+    unchanged_rows
+)
 from borderliner.db.conn_abstract import DatabaseBackend
 from borderliner.db.postgres_lib import PostgresBackend
 from borderliner.db.redshift_lib import RedshiftBackend
+from borderliner.db.async_lib import AsyncPostgresBackend
 # logging
 logging.basicConfig(
     stream=sys.stdout, 
@@ -29,7 +39,8 @@ class PipelineTarget:
             'inserted_rows':0,
             'updated_rows':0,
             'deleted_rows':0,
-            'processed_rows':0
+            'processed_rows':0,
+            'skipped_rows':0
         }
         self.database_module = 'psycopg2'
         self.alchemy_engine_flag = 'psycopg2'
@@ -46,6 +57,7 @@ class PipelineTarget:
 
         self.engine = None
         self.connection = None
+        self.env = None
 
         self.iteration_list = []
         self.deltas = {}
@@ -58,75 +70,482 @@ class PipelineTarget:
         self.password = self.config['password']
         self.host = self.config['host']
         self.port = self.config['port']
+        # engine pool, connection reuse and commit batching settings
+        backend_options = {
+            key:self.config[key] for key in (
+                'pool_size',
+                'max_overflow',
+                'pool_pre_ping',
+                'pool_recycle',
+                'reuse_connections',
+                'commit_every_rows',
+                'commit_every_chunks',
+                'commit_once')
+            if key in self.config
+        }
+        # one pooled connection per parallel load worker
+        load_workers = int(self.config.get('load_workers',1) or 1)
+        if load_workers > 1:
+            backend_options['pool_size'] = max(
+                int(backend_options.get('pool_size',5)),
+                load_workers + 1)
+        self.backend_options = backend_options
+        self.backend = self.make_backend(backend_options)
+        self.engine = self.make_engine()
+
+    def make_backend(self,backend_options:dict)->DatabaseBackend:
         match str(self.config['type']).upper():
             case 'POSTGRES':
-                self.backend = PostgresBackend(
+                return PostgresBackend(
                     host=self.host,
                     database=self.config['database'],
                     user=self.user,
                     password=self.password,
-                    port=self.port
+                    port=self.port,
+                    page_size=self.config.get('page_size',10000),
+                    load_method=self.config.get('load_method','values'),
+                    **backend_options
                 )
             case 'REDSHIFT':
-                self.backend = RedshiftBackend(
+                return RedshiftBackend(
                     host=self.host,
                     database=self.config['database'],
                     user=self.user,
                     password=self.password,
                     port=self.port,
                     staging_schema=self.config.get('staging_schema','staging'),
-                    staging_table=self.config.get('staging_table',None)
+                    staging_table=self.config.get('staging_table',None),
+                    page_size=self.config.get('page_size',10000),
+                    load_method=self.config.get('load_method','values'),
+                    copy_format=self.config.get('copy_format','csv'),
+                    copy_compression=self.config.get('copy_compression','gzip'),
+                    copy_iam_role=self.config.get('copy_iam_role',None),
+                    copy_slices=self.config.get('copy_slices',None),
+                    merge_strategy=self.config.get('merge_strategy','update_insert'),
+                    **backend_options
                 )
-        
-        self.engine = self.backend.get_engine()
-        self.connection = self.backend.get_connection()
+
+    def make_engine(self):
+        return self.backend.get_engine()
     
     def __str__(self) -> str:
         return str(self.config)
     
+    def set_environment(self,env):
+        """
+        Give the backend access to the cloud storage, used by load 
+        methods that stage files before loading (redshift COPY).
+        """
+        self.env = env
+        if env is None or not hasattr(self.backend,'storage_env'):
+            return
+        self.backend.storage_env = env
+        self.backend.storage_root = env.storage.get('storage_root',None)
+        self.backend.storage_prefix = env.storage.get('temp_files_dir','')
+    
+    def flush(self):
+        """
+        Commit the chunks still pending when commits are batched.
+        """
+        if self.backend is not None:
+            self.backend.commit_pending()
+            self.metrics = self.backend.execution_metrics
+
+    def close(self):
+        """
+        Commit the chunks still pending and give the connection held 
+        between chunks back to the pool.
+        """
+        self.flush()
+        if self.backend is not None:
+            self.backend.close_connection()
+
     def load(self,data:pandas.DataFrame|list):
         if self.dump_data_csv:
+            chunk_store = self.kwargs.get('chunk_store',None)
             for filename in self.csv_chunks_files:
-                self.logger.info(f'reading csv {filename}')
-                df = pandas.read_csv(filename)
+                if chunk_store is not None:
+                    df = chunk_store.get(filename)
+                else:
+                    self.logger.info(f'reading dump {filename}')
+                    df = read_dump(filename)
                 self._data=df
                 self.save_data()
+                if chunk_store is not None:
+                    chunk_store.discard(filename)
         else:
             self._data=data
             self.save_data()
         self.metrics = self.backend.execution_metrics
 
+    def load_chunk(self,data:pandas.DataFrame):
+        """
+        Load a single chunk handed by a streaming pipeline, dumps are
+        never re-read since the chunk is already in memory.
+        """
+        self._data=data
+        self.save_data()
+        self._data=[]
+        self.metrics = self.backend.execution_metrics
+
     def save_data(self):
         pass
 
 class PipelineTargetDatabase(PipelineTarget):
     def __init__(self, config: dict,*args,**kwargs) -> None:
         super().__init__(config,*args,**kwargs)
+        # change detection, rows whose hash matches the one stored in 
+        # row_hash_column for the same key are not upserted again
+        self.row_hash_column = self.config.get('row_hash_column',None)
+        self.md5_ignore_fields = list(self.kwargs.get('md5_ignore_fields',[]) or [])
+        self._hash_snapshot:pandas.DataFrame = None
+        # parallel upserts: chunks are hash partitioned on the conflict
+        # key and loaded over load_workers connections
+        self.load_workers = int(self.config.get('load_workers',1) or 1)
+        self._worker_backends:list = []
+        # worker metrics already added to the target backend metrics
+        self._merged_metrics:list = []
+        self._load_executor:ThreadPoolExecutor = None
+
+    @property
+    def conflict_key_columns(self)->list:
+        conflict_key = self.config['conflict_key']
+        if isinstance(conflict_key,list):
+            return [str(e) for e in conflict_key]
+        return [str(e).strip() for e in str(conflict_key).split(',')]
+
+    def load_hash_snapshot(self)->pandas.DataFrame:
+        """
+        Keys and row hashes currently stored in the target, read once 
+        per run. Rows without hash have a null hash.
+        """
+        if self._hash_snapshot is not None:
+            return self._hash_snapshot
+        key_cols = self.conflict_key_columns
+        columns = self.backend.get_table_columns(
+            self.engine,
+            self.config['schema'],
+            self.config['table'])
+        hash_select = self.row_hash_column
+        if self.row_hash_column.lower() not in columns:
+            # column not created yet, every stored row counts as changed
+            hash_select = f'NULL AS {self.row_hash_column}'
+        self._hash_snapshot = pandas.read_sql_query(
+            f"SELECT {','.join(key_cols)}, {hash_select} "
+            f"FROM {self.config['schema']}.{self.config['table']}",
+            self.engine)
+        return self._hash_snapshot
+
+    def skip_unchanged_rows(self,df:pandas.DataFrame)->pandas.DataFrame:
+        """
+        Add the row hash column to df and drop the rows already stored
+        with the same hash.
+        """
+        ignore = self.md5_ignore_fields + [self.row_hash_column]
+        hashes = fingerprint_to_text(row_fingerprints(df,ignore))
+        unchanged = unchanged_rows(
+            df,
+            hashes,
+            self.load_hash_snapshot(),
+            self.conflict_key_columns,
+            self.row_hash_column)
+        df = df.assign(**{self.row_hash_column:hashes.values})
+        skipped = int(unchanged.sum())
+        if skipped:
+            self.backend.execution_metrics['skipped_rows'] += skipped
+            self.backend.execution_metrics['processed_rows'] += skipped
+            df = df[~unchanged]
+        return df
+
+    def update_hash_snapshot(self,df:pandas.DataFrame):
+        """
+        Record the hashes of the rows just written, so the next chunks
+        compare against what the target holds now.
+        """
+        if self._hash_snapshot is None:
+            return
+        self._hash_snapshot = merge_snapshot(
+            self._hash_snapshot,
+            df,
+            self.conflict_key_columns,
+            self.row_hash_column)
+
+    @property
+    def parallel_load(self)->bool:
+        # redshift shares one staging table and serializes writes anyway
+        return self.load_workers > 1 and type(self.backend) is PostgresBackend
+
+    def worker_backends(self)->list:
+        """
+        Backends of the load workers, built like the target backend with
+        their own connection, transaction, schema cache and metrics. 
+        They load through the target engine pool.
+        """
+        while len(self._worker_backends) < self.load_workers:
+            self._worker_backends.append(self.make_backend(self.backend_options))
+            self._merged_metrics.append({})
+        if self._load_executor is None:
+            self._load_executor = ThreadPoolExecutor(
+                max_workers=self.load_workers,
+                thread_name_prefix='borderliner-load')
+        return self._worker_backends
+
+    def merge_worker_metrics(self):
+        # add what changed since the last merge, rolled back chunks 
+        # lower the worker counters
+        for worker, merged in zip(self._worker_backends,self._merged_metrics):
+            for key, value in worker.execution_metrics.items():
+                self.backend.execution_metrics[key] = \
+                    self.backend.execution_metrics.get(key,0) + value - merged.get(key,0)
+                merged[key] = value
+
+    def partition_frame(self,df:pandas.DataFrame,parts:int)->list:
+        """
+        Split df in parts by a hash of the conflict key, every key lands
+        in exactly one part.
+        """
+        buckets = pandas.util.hash_pandas_object(
+            df[self.conflict_key_columns],
+            index=False).to_numpy() % parts
+        return [df[buckets == part] for part in range(parts)]
+
+    def parallel_insert_on_conflict(self,df:pandas.DataFrame,conflict_action='update'):
+        """
+        Upsert the partitions of df at the same time, one worker 
+        connection each. Workers never touch the same key so they do 
+        not wait on each other's row locks.
+        """
+        schema = self.config['schema']
+        table = self.config['table']
+        # columns are added once, before the workers start
+        columns = self.backend.get_table_columns(self.engine,schema,table)
+        if any(str(c).lower() not in columns for c in df.columns):
+            # the ALTER would wait on the locks of uncommitted worker chunks
+            for worker in self._worker_backends:
+                worker.commit_pending()
+            self.merge_worker_metrics()
+        added = self.backend.ensure_columns(self.engine,df,schema,table)
+        workers = self.worker_backends()
+        if added:
+            for worker in workers:
+                worker.invalidate_schema_cache(schema,table)
+        futures = []
+        for worker, part in zip(workers,self.partition_frame(df,len(workers))):
+            if part.empty:
+                continue
+            futures.append(self._load_executor.submit(
+                worker.insert_on_conflict,
+                self.engine,
+                part,
+                schema,
+                table,
+                if_exists='append',
+                conflict_action=conflict_action,
+                conflict_key=self.config['conflict_key']))
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        self.merge_worker_metrics()
+        if errors:
+            raise Exception(
+                f'{len(errors)} of {len(futures)} load workers failed: {errors[0]}')
+
+    def upsert_frame(self,df:pandas.DataFrame,conflict_action='update'):
+        if self.parallel_load and len(df) > 1:
+            self.parallel_insert_on_conflict(df,conflict_action)
+            return
+        self.backend.insert_on_conflict(
+            self.engine,
+            df,
+            self.config['schema'],
+            self.config['table'],
+            if_exists='append',
+            conflict_action=conflict_action,
+            conflict_key=self.config['conflict_key']
+        )
+
+    def flush(self):
+        for worker in self._worker_backends:
+            worker.commit_pending()
+        self.merge_worker_metrics()
+        super().flush()
+
+    def close(self):
+        super().close()
+        for worker in self._worker_backends:
+            worker.close_connection()
+        if self._load_executor is not None:
+            self._load_executor.shutdown()
+            self._load_executor = None
+
+    def save_frame(self,df:pandas.DataFrame):
+        if self.row_hash_column:
+            df = self.skip_unchanged_rows(df)
+            if df.empty:
+                return
+        self.upsert_frame(df,'update')
+        if self.row_hash_column:
+            self.update_hash_snapshot(df)
+
+    def apply_deltas(self,deltas:dict):
+        """
+        Apply a change set computed by populate_deltas: new rows are 
+        inserted (DO NOTHING on conflict), changed rows upserted and
+        missing keys deleted.
+        """
+        schema = self.config['schema']
+        table = self.config['table']
+        if len(deltas['insert']):
+            self.upsert_frame(deltas['insert'],'nothing')
+        if len(deltas['update']):
+            self.upsert_frame(deltas['update'],'update')
+        if len(deltas['delete']):
+            self.backend.delete_keys(
+                self.engine,
+                deltas['delete'],
+                schema,
+                table,
+                list(deltas['delete'].columns))
+        self.metrics = self.backend.execution_metrics
 
     def save_data(self):
         if isinstance(self._data,pandas.DataFrame):
-            self.backend.insert_on_conflict(
-                self.engine,
-                self._data,
+            self.save_frame(self._data)
+        if isinstance(self._data,list):
+            for df in self._data:
+                self.save_frame(df)
+        
+        
+
+class AsyncPipelineTargetDatabase(PipelineTargetDatabase):
+    """
+    Postgres target written through asyncpg, for pipelines driven by an
+    event loop.
+    """
+    def make_backend(self,backend_options:dict)->DatabaseBackend:
+        if str(self.config['type']).upper() != 'POSTGRES':
+            raise ValueError('async targets support POSTGRES only')
+        return AsyncPostgresBackend(
+            host=self.host,
+            database=self.config['database'],
+            user=self.user,
+            password=self.password,
+            port=self.port,
+            **{key:self.config[key] for key in (
+                'pool_size',
+                'max_overflow',
+                'pool_min_size',
+                'dtype_sample_size')
+            if key in self.config}
+        )
+
+    def make_engine(self):
+        return None
+
+    def upsert_frame(self,df:pandas.DataFrame,conflict_action='update'):
+        raise TypeError(
+            'async targets load through aload/aload_chunk, run the pipeline with run_async')
+
+    def apply_deltas(self,deltas:dict):
+        raise TypeError(
+            'async targets load through aapply_deltas, run the pipeline with run_async')
+
+    async def aload_hash_snapshot(self)->pandas.DataFrame:
+        if self._hash_snapshot is not None:
+            return self._hash_snapshot
+        key_cols = self.conflict_key_columns
+        pool = await self.backend.get_pool()
+        async with pool.acquire() as connection:
+            columns = await self.backend.get_table_columns(
+                connection,
                 self.config['schema'],
-                self.config['table'],
+                self.config['table'])
+        hash_select = self.row_hash_column
+        if self.row_hash_column.lower() not in columns:
+            hash_select = f'NULL AS {self.row_hash_column}'
+        self._hash_snapshot = await self.backend.fetch_frame(
+            f"SELECT {','.join(key_cols)}, {hash_select} "
+            f"FROM {self.config['schema']}.{self.config['table']}")
+        return self._hash_snapshot
+
+    async def asave_frame(self,df:pandas.DataFrame):
+        if self.row_hash_column:
+            await self.aload_hash_snapshot()
+            df = self.skip_unchanged_rows(df)
+            if df.empty:
+                return
+        await self.backend.insert_on_conflict(
+            df,
+            self.config['schema'],
+            self.config['table'],
+            if_exists='append',
+            conflict_action='update',
+            conflict_key=self.config['conflict_key']
+        )
+        if self.row_hash_column:
+            self.update_hash_snapshot(df)
+
+    async def asave_data(self):
+        if isinstance(self._data,pandas.DataFrame):
+            await self.asave_frame(self._data)
+        if isinstance(self._data,list):
+            for df in self._data:
+                await self.asave_frame(df)
+
+    async def aload(self,data:pandas.DataFrame|list):
+        if self.dump_data_csv:
+            chunk_store = self.kwargs.get('chunk_store',None)
+            for filename in self.csv_chunks_files:
+                if chunk_store is not None:
+                    df = chunk_store.get(filename)
+                else:
+                    df = await asyncio.to_thread(read_dump,filename)
+                self._data = df
+                await self.asave_data()
+                if chunk_store is not None:
+                    chunk_store.discard(filename)
+        else:
+            self._data = data
+            await self.asave_data()
+        self.metrics = self.backend.execution_metrics
+
+    async def aload_chunk(self,data:pandas.DataFrame):
+        self._data = data
+        await self.asave_data()
+        self._data = []
+        self.metrics = self.backend.execution_metrics
+
+    async def aapply_deltas(self,deltas:dict):
+        schema = self.config['schema']
+        table = self.config['table']
+        if len(deltas['insert']):
+            await self.backend.insert_on_conflict(
+                deltas['insert'],
+                schema,
+                table,
+                if_exists='append',
+                conflict_action='nothing',
+                conflict_key=self.config['conflict_key']
+            )
+        if len(deltas['update']):
+            await self.backend.insert_on_conflict(
+                deltas['update'],
+                schema,
+                table,
                 if_exists='append',
                 conflict_action='update',
                 conflict_key=self.config['conflict_key']
             )
-        if isinstance(self._data,list):
-            for df in self._data:
-                self.backend.insert_on_conflict(
-                    self.engine,
-                    df,
-                    self.config['schema'],
-                    self.config['table'],
-                    if_exists='append',
-                    conflict_action='update',
-                    conflict_key=self.config['conflict_key']
-                )
-        
-        
+        if len(deltas['delete']):
+            await self.backend.delete_keys(
+                deltas['delete'],
+                schema,
+                table,
+                list(deltas['delete'].columns))
+        self.metrics = self.backend.execution_metrics
 
 class PipelineTargetApi(PipelineTarget):
     pass
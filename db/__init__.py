@@ -1,6 +1,9 @@
 __all__ = [
+    'async_lib',
     'conn_abstract',
+    'encoders',
     'ibm_db2',
+    'instrumentation',
     'postgres_lib',
     'redshift_lib'
 ]
\ No newline at end of file
@@ -0,0 +1,287 @@
+from .postgres_lib import PostgresBackend
+from .encoders import copy_csv
+import asyncio
+import io
+import sys
+import time
+import pandas
+try:
+    import asyncpg
+except ImportError:
+    # optional, only needed by async pipelines
+    asyncpg = None
+
+# logging
+import logging
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format='[%(asctime)s] %(levelname)s - %(message)s'
+    )
+logger = logging.getLogger()
+
+# asyncpg pools shared by every async backend of the event loop, keyed
+# by server, database, user and loop (pools are bound to their loop)
+_pool_registry = {}
+
+async def get_registered_pool(min_size:int=1,max_size:int=10,**connect_args):
+    """
+    Pool for connect_args created on first use in the running loop and
+    shared afterwards. Call close_pools before the loop ends.
+    """
+    if asyncpg is None:
+        raise ImportError('asyncpg is required by async pipelines: pip install asyncpg')
+    loop = asyncio.get_running_loop()
+    key = (
+        connect_args.get('host'),
+        str(connect_args.get('port')),
+        connect_args.get('database'),
+        connect_args.get('user'),
+        loop)
+    if key not in _pool_registry:
+        # concurrent first callers wait on the same pool creation
+        _pool_registry[key] = loop.create_task(asyncpg.create_pool(
+            min_size=min_size,
+            max_size=max_size,
+            **connect_args))
+    task = _pool_registry[key]
+    try:
+        return await task
+    except Exception:
+        # a failed connect is not kept for the next callers
+        if _pool_registry.get(key) is task:
+            _pool_registry.pop(key)
+        raise
+
+async def close_pools():
+    """
+    Close the pools registered in the running loop.
+    """
+    loop = asyncio.get_running_loop()
+    for key in [k for k in _pool_registry if k[-1] is loop]:
+        task = _pool_registry.pop(key)
+        try:
+            pool = await task
+        except Exception:
+            continue
+        await pool.close()
+
+def _command_rows(status:str)->int:
+    # asyncpg returns the command tag, 'INSERT 0 10', 'DELETE 3'...
+    try:
+        return int(str(status).split()[-1])
+    except (ValueError,IndexError):
+        return 0
+
+class AsyncPostgresBackend(PostgresBackend):
+    """
+    Postgres backend on asyncpg for pipelines run by an event loop.
+
+    Connections come from a pool shared by every backend of the loop
+    (pool_size connections, plus max_overflow). Each chunk is loaded in
+    its own transaction, the commit_every_* options do not apply.
+    """
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.interface_name = 'postgres_async'
+        self.pool_min_size = int(kwargs.get('pool_min_size',1))
+        self.pool_max_size = int(kwargs.get('pool_size',10) or 10) \
+            + int(kwargs.get('max_overflow',0) or 0)
+        self.pool = None
+
+    @property
+    def connect_args(self)->dict:
+        return {
+            'host':self.host,
+            'port':int(self.port) if self.port else 5432,
+            'database':self.database,
+            'user':self.user,
+            'password':self.password
+        }
+
+    async def get_pool(self):
+        if self.pool is None:
+            self.pool = await get_registered_pool(
+                self.pool_min_size,
+                self.pool_max_size,
+                **self.connect_args)
+        return self.pool
+
+    async def fetch_frame(self,query:str)->pandas.DataFrame:
+        pool = await self.get_pool()
+        async with pool.acquire() as connection:
+            statement = await connection.prepare(query)
+            records = await statement.fetch()
+            columns = [a.name for a in statement.get_attributes()]
+        return pandas.DataFrame.from_records(
+            [tuple(r) for r in records],
+            columns=columns,
+            coerce_float=True)
+
+    async def iter_query(self,query:str,chunk_size:int=10000,prefetch:int=None):
+        """
+        Stream query results through a server side cursor, yielding a
+        dataframe of chunk_size rows at a time.
+        """
+        pool = await self.get_pool()
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                statement = await connection.prepare(query)
+                columns = [a.name for a in statement.get_attributes()]
+                cursor = await statement.cursor(prefetch=prefetch or chunk_size)
+                yielded = False
+                while True:
+                    records = await cursor.fetch(int(chunk_size))
+                    if not records:
+                        if not yielded:
+                            yield pandas.DataFrame(columns=columns)
+                        break
+                    yielded = True
+                    yield pandas.DataFrame.from_records(
+                        [tuple(r) for r in records],
+                        columns=columns,
+                        coerce_float=True)
+
+    async def get_table_columns(self,connection,schema,table_name)->dict:
+        key = (str(schema).lower(),str(table_name).lower())
+        if key in self._schema_cache:
+            return self._schema_cache[key]
+        rows = await connection.fetch(self._table_columns_query(schema,table_name))
+        return self._cache_table_columns(schema,table_name,rows)
+
+    async def ensure_columns(self,connection,df,schema,table_name,if_not_exists='append'):
+        columns = await self.get_table_columns(connection,schema,table_name)
+        missing, clauses = self._add_column_clauses(
+            df,columns,schema,table_name,if_not_exists)
+        if not missing:
+            return []
+        try:
+            await connection.execute(
+                f"ALTER TABLE {schema}.{table_name} {', '.join(clauses)}")
+        finally:
+            self.invalidate_schema_cache(schema,table_name)
+        logger.info(f'columns {missing} added to {schema}.{table_name}')
+        return missing
+
+    async def _stage_frame(self,connection,df:pandas.DataFrame,schema,table_name,stage_table)->int:
+        """
+        COPY df into a temp table shaped like the target columns,
+        dropped at the end of the transaction.
+        """
+        col_names = ','.join(str(e) for e in df.columns)
+        await connection.execute(f"""
+            CREATE TEMP TABLE {stage_table} ON COMMIT DROP AS
+                SELECT {col_names} FROM {schema}.{table_name}
+                WITH NO DATA""")
+        buffer = io.BytesIO(copy_csv(df,self.page_size).encode('utf-8'))
+        status = await connection.copy_to_table(
+            stage_table,
+            source=buffer,
+            columns=[str(e) for e in df.columns],
+            format='csv')
+        staged = _command_rows(status)
+        self.execution_metrics['staged_rows'] += staged
+        return staged
+
+    async def insert_on_conflict(
+        self,
+        df:pandas.DataFrame,
+        schema,
+        table_name,
+        if_exists='append',
+        conflict_key=None,
+        conflict_action=None):
+        """
+        Process method to insert dataframes in database target, the
+        chunk is staged with COPY and merged with one statement.
+        """
+        if if_exists != 'append':
+            return
+        try:
+            pool = await self.get_pool()
+            self.execution_metrics['processed_rows'] += len(df)
+            if isinstance(conflict_key,list):
+                conflict_key = ','.join(str(e) for e in conflict_key)
+            if conflict_key != None \
+                and str(conflict_action).lower() == 'update':
+                df = self._drop_duplicate_keys(df,conflict_key)
+            col_names = ','.join(str(e) for e in df.columns)
+            stage_table = f'{table_name}_async_stage'
+            inserted, updated = 0, 0
+            async with pool.acquire() as connection:
+                await self.ensure_columns(connection,df,schema,table_name)
+                started = time.perf_counter()
+                async with connection.transaction():
+                    await self._stage_frame(
+                        connection,
+                        df,
+                        schema,
+                        table_name,
+                        stage_table)
+                    SELECT_SQL = f"SELECT {col_names} FROM {stage_table}"
+                    match str(conflict_action).lower() if conflict_key != None else None:
+                        case 'update':
+                            conflict_set = ','.join(str(e) for e in df.columns)
+                            excluded_set = ','.join('EXCLUDED.' + str(e) for e in df.columns)
+                            metrics = await connection.fetchrow(f"""
+                                WITH t as (
+                                INSERT INTO {schema}.{table_name} ({col_names})
+                                    {SELECT_SQL}
+                                ON CONFLICT
+                                    ({conflict_key})
+                                DO UPDATE SET
+                                    ({conflict_set})=({excluded_set}) RETURNING xmax)
+                                    SELECT COUNT(*) AS all_rows,
+                                    SUM(CASE WHEN xmax = 0 THEN 1 ELSE 0 END) AS ins,
+                                    SUM(CASE WHEN xmax::text::int > 0 THEN 1 ELSE 0 END) AS upd
+                                FROM t""")
+                            inserted, updated = int(metrics[1] or 0), int(metrics[2] or 0)
+                        case 'nothing':
+                            status = await connection.execute(f"""
+                                INSERT INTO {schema}.{table_name} ({col_names})
+                                    {SELECT_SQL}
+                                ON CONFLICT
+                                    ({conflict_key})
+                                DO NOTHING""")
+                            inserted = _command_rows(status)
+                        case _:
+                            status = await connection.execute(f"""
+                                INSERT INTO {schema}.{table_name} ({col_names})
+                                    {SELECT_SQL}""")
+                            inserted = _command_rows(status)
+                # counted once the transaction is committed
+                self.execution_metrics['inserted_rows'] += inserted
+                self.execution_metrics['updated_rows'] += updated
+                self.execution_metrics['commits'] += 1
+                self.execution_metrics['commit_seconds'] += time.perf_counter() - started
+        except Exception as e:
+            raise Exception('db exception:'+str(e))
+
+    async def delete_keys(self,keys:pandas.DataFrame,schema,table_name,key_cols:list):
+        """
+        Delete the rows of schema.table_name matching the keys dataframe.
+        """
+        if len(keys) == 0:
+            return 0
+        try:
+            pool = await self.get_pool()
+            stage_table = f'{table_name}_async_keys'
+            join_key = ' AND '.join(
+                f'{table_name}.{key} = stg.{key}' for key in key_cols)
+            async with pool.acquire() as connection:
+                async with connection.transaction():
+                    await self._stage_frame(
+                        connection,
+                        keys[key_cols],
+                        schema,
+                        table_name,
+                        stage_table)
+                    status = await connection.execute(f"""
+                        DELETE FROM {schema}.{table_name}
+                        USING {stage_table} stg
+                        WHERE {join_key}""")
+            deleted = _command_rows(status)
+            self.execution_metrics['deleted_rows'] += deleted
+            return deleted
+        except Exception as e:
+            raise Exception('db exception:'+str(e))
@@ -1,14 +1,21 @@
 from typing import Any
 from sqlalchemy.engine import Engine
 import psycopg2
+from psycopg2.extras import execute_values
+from .encoders import iter_rows
+from .instrumentation import get_instrumentations
+from pandas._libs.lib import infer_dtype
+from pandas.io.sql import _SQL_TYPES
 from sqlalchemy import create_engine
 import os
 import warnings
 
 import sys
-import inspect
 import time
-import traceback
+import uuid
+import itertools
+import threading
+import pandas
 
 from sqlalchemy import event
 from sqlalchemy.orm.session import sessionmaker
@@ -23,41 +30,30 @@ logging.basicConfig(
     format='[%(asctime)s] %(levelname)s - %(message)s'
     )
 logger = logging.getLogger()
-class QueryStats(object):
-    def __init__(self):
-        self.count = 0
-        self.total_time = 0.0
-
-        self._query_log = []
-        self.query_info = None
-        print('QueryStats INIT')
-
-    def start_query(self, statement, parameters):
-        if self.query_info is not None:
-            self._query_log.append( self.query_info + (float('nan'),) )
-
-        stack = extract_user_stack(1)
-
-        self.query_info = (time.time(), statement, parameters, stack)
-        self.count += 1
-
-    def end_query(self):
-        assert self.query_info is not None
-
-        query_end = time.time()
-        self.total_time += query_end - self.query_info[0]
-        self._query_log.append( self.query_info + (query_end - self.query_info[0],) )
-
-        self.query_info = None
-
-    @property
-    def query_log(self):
-        if self.query_info is not None:
-            return self._query_log + [ self.query_info + (float('nan'),) ]
-        return self._query_log
-
-    def __repr__(self):
-        return '<QueryStats count=%d time=%.2fs>' % (self.count, self.total_time)
+# engines shared by every backend of the process, keyed by uri
+_engine_registry = {}
+_engine_registry_lock = threading.Lock()
+
+def get_registered_engine(uri:str,*args,**kwargs)->Engine:
+    """
+    Engine (and its connection pool) for uri and the given create_engine
+    arguments, created on first use and shared by the callers asking for
+    the same pool options.
+    """
+    key = (uri,repr(args),repr(sorted(kwargs.items())))
+    with _engine_registry_lock:
+        if key not in _engine_registry:
+            _engine_registry[key] = create_engine(uri,*args,**kwargs)
+        return _engine_registry[key]
+
+def dispose_engines():
+    """
+    Close every pooled connection of the registered engines.
+    """
+    with _engine_registry_lock:
+        for engine in _engine_registry.values():
+            engine.dispose()
+        _engine_registry.clear()
 
 class DatabaseBackend:
     def __init__(self,*args,**kwargs):
@@ -83,12 +79,49 @@ class DatabaseBackend:
 
         self.session = None
         self.engine = None
+        # rows sent per statement by execute_values
+        self.page_size = int(kwargs.get('page_size',10000))
+        # pool settings of the shared engine
+        self.pool_options = {
+            key:kwargs[key] for key in (
+                'pool_size',
+                'max_overflow',
+                'pool_pre_ping',
+                'pool_recycle') 
+            if kwargs.get(key,None) is not None
+        }
+        # keep the raw connection checked out between chunks
+        self.reuse_connections = bool(kwargs.get('reuse_connections',True))
+        self._raw_connection = None
+        # transaction scope of multi chunk loads: commit every N chunks,
+        # every N rows or once per run, chunks run inside a savepoint
+        self.commit_every_rows = int(kwargs.get('commit_every_rows',0) or 0)
+        self.commit_every_chunks = int(
+            kwargs.get('commit_every_chunks',0 if self.commit_every_rows else 1) or 0)
+        self.commit_once = bool(kwargs.get('commit_once',False))
+        self.supports_savepoints = True
+        self._pending_chunks = 0
+        self._pending_rows = 0
+        self._savepoint_open = False
+        # rows used to infer the sql type of a new column
+        self.dtype_sample_size = int(kwargs.get('dtype_sample_size',1000))
+        # (schema, table) -> {column_name: data_type}
+        self._schema_cache = {}
+        # some databases (redshift) accept a single ADD COLUMN per ALTER
+        self.multiple_add_column = True
         self.execution_metrics = {
             'inserted_rows':0,
             'updated_rows':0,
             'deleted_rows':0,
             'processed_rows':0,
+            'skipped_rows':0,
+            'commits':0,
+            'commit_seconds':0.0,
             }
+        # row counters as of the last commit and of the chunk start, 
+        # restored when a chunk or the pending chunks are rolled back
+        self._committed_rows = self._row_counters()
+        self._chunk_rows = self._committed_rows
         #self.set_engine()
 
     def __str__(self) -> str:
@@ -104,8 +137,6 @@ class DatabaseBackend:
     @staticmethod
     def _sql_type_name(col_type):
 
-        from pandas.io.sql import _SQL_TYPES
-
         if col_type == 'timedelta64':
             warnings.warn("the 'timedelta' type is not supported, and will be "
                           "written as integer values (ns frequency) to the "
@@ -126,6 +157,125 @@ class DatabaseBackend:
 
         return _SQL_TYPES[col_type]
 
+    def get_table_columns(
+        self,
+        active_connection:Engine,
+        schema,
+        table_name)->dict:
+        """
+        Returns {column_name: data_type} for schema.table_name.
+
+        Columns are read from information_schema once per table and kept
+        until invalidate_schema_cache is called (every DDL does it).
+        """
+        key = (str(schema).lower(),str(table_name).lower())
+        if key in self._schema_cache:
+            return self._schema_cache[key]
+        rows = active_connection.execute(
+            self._table_columns_query(schema,table_name)).fetchall()
+        return self._cache_table_columns(schema,table_name,rows)
+
+    def _table_columns_query(self,schema,table_name)->str:
+        return f"SELECT column_name, data_type FROM information_schema.columns " \
+            f"where table_schema = '{str(schema).lower()}' " \
+            f"and table_name = '{str(table_name).lower()}'"
+
+    def _cache_table_columns(self,schema,table_name,rows)->dict:
+        key = (str(schema).lower(),str(table_name).lower())
+        self._schema_cache[key] = {
+            str(row[0]).lower():row[1] for row in rows
+        }
+        return self._schema_cache[key]
+
+    def invalidate_schema_cache(self,schema=None,table_name=None):
+        """
+        Drop cached columns of one table, or of every table if no table 
+        is given.
+        """
+        if table_name is None:
+            self._schema_cache = {}
+            return
+        self._schema_cache.pop(
+            (str(schema).lower(),str(table_name).lower()),None)
+
+    def ensure_columns(
+        self,
+        active_connection:Engine,
+        df,
+        schema,
+        table_name,
+        if_not_exists='append'):
+        """
+        Add every column of df missing in schema.table_name.
+
+        Types of new columns are inferred from a sample of the chunk and
+        all ALTERs are sent in one statement when the database allows it.
+        Returns the list of added columns.
+        """
+        columns = self.get_table_columns(active_connection,schema,table_name)
+        missing, clauses = self._add_column_clauses(
+            df,columns,schema,table_name,if_not_exists)
+        if not missing:
+            return []
+        # the ALTER runs on another connection and would wait for the 
+        # locks of uncommitted chunks
+        self.commit_pending()
+        try:
+            if self.multiple_add_column:
+                active_connection.execute(
+                    f"ALTER TABLE {schema}.{table_name} {', '.join(clauses)}")
+            else:
+                for clause in clauses:
+                    active_connection.execute(
+                        f"ALTER TABLE {schema}.{table_name} {clause}")
+        finally:
+            self.invalidate_schema_cache(schema,table_name)
+        logger.info(f'columns {missing} added to {schema}.{table_name}')
+        return missing
+
+    def _add_column_clauses(self,df,columns:dict,schema,table_name,if_not_exists='append'):
+        """
+        Columns of df missing in the table and their ADD COLUMN clauses,
+        typed from a sample of the chunk.
+        """
+        missing = [c for c in df.columns if str(c).lower() not in columns]
+        if missing and if_not_exists != 'append':
+            raise ValueError(
+                f'columns {missing} not found in {schema}.{table_name}')
+        clauses = []
+        for column in missing:
+            sample = df[column].dropna().head(self.dtype_sample_size)
+            dt = self._sql_type_name(infer_dtype(sample))
+            clauses.append(f'ADD COLUMN {str(column).lower()} {dt}')
+        return missing, clauses
+
+    def column_exists_db(
+        self,
+        active_connection:Engine,
+        table_name, 
+        column_name, 
+        dtype, 
+        if_not_exists='append',
+        schema='public'):
+        """
+        Check if colunm exists on db, adding it when if_not_exists is 
+        'append'. Uses the schema cache, see ensure_columns for whole 
+        dataframes.
+        """
+        columns = self.get_table_columns(active_connection,schema,table_name)
+        if str(column_name).lower() in columns:
+            return 0
+        if if_not_exists != 'append':
+            raise ValueError(
+                f'column {column_name} not found in {schema}.{table_name}')
+        dt = self._sql_type_name(str(dtype))
+        try:
+            active_connection.execute(
+                f"ALTER TABLE {schema}.{table_name} ADD COLUMN {str(column_name).lower()} {dt}")
+        finally:
+            self.invalidate_schema_cache(schema,table_name)
+        return 0
+
     @property
     def uri(self):
         s = str(f'{self.alchemy_engine_flag}://{self.user}:{self.password}@{self.host}/{self.database}')
@@ -147,7 +297,6 @@ class DatabaseBackend:
     def set_engine(self,*args,**kwargs)->Engine:
         engine = create_engine(self.uri,*args,**kwargs)
         session = sessionmaker(bind=engine)()
-        setup_session_tracking(session)
         self.engine = engine
         self.session = session
 
@@ -155,11 +304,168 @@ class DatabaseBackend:
     def get_engine(self,*args,**kwargs)->Engine:
         if isinstance(self.engine,Engine):
             return self.engine
-        self.engine = create_engine(self.uri,connect_args={'sslmode': 'prefer'},*args,**kwargs)
+        engine_args = {**self.pool_options,**kwargs}
+        self.engine = get_registered_engine(
+            self.uri,
+            connect_args={'sslmode': 'prefer'},
+            *args,
+            **engine_args)
         self.session = sessionmaker(bind=self.engine)()
-        setup_session_tracking(self.session)
         return self.engine
 
+    def acquire_connection(self,active_connection:Engine):
+        """
+        Raw DBAPI connection used by the load methods, checked out from
+        the pool on first use and reused by the next chunks.
+        """
+        if self._raw_connection is None:
+            self._raw_connection = active_connection.raw_connection()
+        return self._raw_connection
+
+    def release_connection(self):
+        """
+        Called once a chunk is done, the connection goes back to the 
+        pool only when reuse_connections is off and nothing is left to
+        commit.
+        """
+        if not self.reuse_connections and not self._pending_chunks:
+            self.close_connection()
+
+    @property
+    def batched_commits(self)->bool:
+        return self.commit_once \
+            or self.commit_every_rows > 0 \
+            or self.commit_every_chunks > 1
+
+    def _row_counters(self)->dict:
+        return {
+            key:self.execution_metrics[key] 
+            for key in ('inserted_rows','updated_rows','deleted_rows')}
+
+    def begin_chunk(self,cursor):
+        """
+        Open a savepoint for the chunk when commits are batched, so a
+        failed chunk does not roll back the previous ones.
+        """
+        self._chunk_rows = self._row_counters()
+        if self.batched_commits and self.supports_savepoints:
+            cursor.execute('SAVEPOINT borderliner_chunk;')
+            self._savepoint_open = True
+
+    def end_chunk(self,connection,rows:int):
+        """
+        Mark a chunk as done and commit when the configured number of 
+        chunks or rows is pending.
+        """
+        if self._savepoint_open:
+            cursor = connection.cursor()
+            cursor.execute('RELEASE SAVEPOINT borderliner_chunk;')
+            cursor.close()
+            self._savepoint_open = False
+        self._pending_chunks += 1
+        self._pending_rows += int(rows)
+        if self.commit_once:
+            return
+        if (self.commit_every_rows > 0 and self._pending_rows >= self.commit_every_rows) \
+            or (self.commit_every_chunks > 0 and self._pending_chunks >= self.commit_every_chunks):
+            self.commit_pending()
+
+    def fail_chunk(self):
+        """
+        Undo a failed chunk. Inside a savepoint only the chunk is rolled
+        back and the previous chunks are committed, otherwise the whole
+        transaction is rolled back.
+        """
+        connection = self._raw_connection
+        if connection is None:
+            return
+        if self._savepoint_open:
+            self._savepoint_open = False
+            try:
+                cursor = connection.cursor()
+                cursor.execute('ROLLBACK TO SAVEPOINT borderliner_chunk;')
+                cursor.close()
+                self.execution_metrics.update(self._chunk_rows)
+                self.commit_pending()
+                return
+            except Exception as e:
+                logger.error(f'rollback to savepoint failed: {e}')
+        self.execution_metrics.update(self._committed_rows)
+        self._pending_chunks = 0
+        self._pending_rows = 0
+        self.close_connection(rollback=True)
+
+    def commit_pending(self):
+        """
+        Commit the chunks loaded since the last commit.
+        """
+        connection = self._raw_connection
+        if connection is None or not self._pending_chunks:
+            return
+        started = time.perf_counter()
+        connection.commit()
+        self.execution_metrics['commit_seconds'] += time.perf_counter() - started
+        self.execution_metrics['commits'] += 1
+        self._committed_rows = self._row_counters()
+        self._pending_chunks = 0
+        self._pending_rows = 0
+
+    def close_connection(self,rollback:bool=False):
+        """
+        Return the held connection to the pool, rolling back the open
+        transaction when asked (after errors).
+        """
+        connection = self._raw_connection
+        if connection is None:
+            return
+        self._raw_connection = None
+        try:
+            if rollback:
+                connection.rollback()
+        finally:
+            connection.close()
+
+    def iter_query(
+        self,
+        active_connection:Engine,
+        query:str,
+        chunk_size:int=10000,
+        itersize:int=10000):
+        """
+        Stream query results through a server side (named) cursor.
+
+        Rows are fetched itersize at a time by the driver and yielded as
+        dataframes of chunk_size rows, so memory and time to first row 
+        do not depend on the result size.
+        """
+        connection = active_connection.raw_connection()
+        cursor = connection.cursor(name=f'borderliner_{uuid.uuid4().hex}')
+        cursor.itersize = int(itersize)
+        try:
+            cursor.execute(query)
+            yielded = False
+            rows = []
+            # iterating the named cursor fetches itersize rows per round
+            # trip, fetchmany would fetch chunk_size instead
+            for row in cursor:
+                rows.append(row)
+                if len(rows) >= int(chunk_size):
+                    yielded = True
+                    yield pandas.DataFrame.from_records(
+                        rows,
+                        columns=[d[0] for d in cursor.description],
+                        coerce_float=True)
+                    rows = []
+            if rows or not yielded:
+                yield pandas.DataFrame.from_records(
+                    rows,
+                    columns=[d[0] for d in cursor.description],
+                    coerce_float=True)
+        finally:
+            cursor.close()
+            connection.commit()
+            connection.close()
+
     def record_exists(self,*args,**kwargs)->bool:
         pass
 
@@ -184,6 +490,50 @@ class DatabaseBackend:
         """
         logger.critical(f'your database lib does not implement insert_on_conflict method')
     
+    def delete_keys(
+        self,
+        active_connection:Engine,
+        keys,
+        schema,
+        table_name,
+        key_cols:list):
+        """
+        Delete the rows of schema.table_name matching the keys dataframe,
+        page_size keys per statement.
+        """
+        if len(keys) == 0:
+            return 0
+        connection = self.acquire_connection(active_connection)
+        cursor = connection.cursor()
+        deleted = 0
+        try:
+            cols = ','.join(str(e) for e in key_cols)
+            template = '(' + ','.join(['%s']*len(key_cols)) + ')'
+            DELETE_SQL = f"""
+                DELETE FROM {schema}.{table_name}
+                WHERE ({cols}) IN (%s)"""
+            self.begin_chunk(cursor)
+            rows = iter_rows(keys[key_cols],self.page_size)
+            while True:
+                page = list(itertools.islice(rows,self.page_size))
+                if not page:
+                    break
+                execute_values(
+                    cursor,
+                    DELETE_SQL,
+                    page,
+                    template=template,
+                    page_size=self.page_size)
+                deleted += cursor.rowcount
+            cursor.close()
+            self.execution_metrics['deleted_rows'] += deleted
+            self.end_chunk(connection,deleted)
+            self.release_connection()
+        except Exception as e:
+            self.fail_chunk()
+            raise Exception('db exception:'+str(e))
+        return deleted
+
     def val_record_exists(self,p_cur, p_tab, p_pk_cols, p_pks):
         """checks if the record already exists in the target table / member."""
         p_cur.execute("select  count(1)  FROM "+p_tab+"  where (" + p_pk_cols + ") =  (" + p_pks + ")")
@@ -242,51 +592,17 @@ class DatabaseBackend:
 
 @event.listens_for(Engine, 'before_cursor_execute')
 def on_query_start(conn, cursor, statement, parameters, context, executemany):
-    if hasattr(conn, '_query_stats'):
-        conn._query_stats.start_query(statement, parameters)
+    if get_instrumentations(conn.engine):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
 
 @event.listens_for(Engine, 'after_cursor_execute')
 def on_query_end(conn, cursor, statement, parameters, context, executemany):
-    if hasattr(conn, '_query_stats'):
-        conn._query_stats.end_query()
-
-def setup_session_tracking(session):
-    """ Enables the stats tracking for a Session or a Session factory """
-    @event.listens_for(session, 'after_begin')
-    def on_begin(session, transaction, connection):
-        if not hasattr(session, '_query_stats'):
-            session._query_stats = QueryStats()
-
-        connection._query_stats = session._query_stats
-
-    @event.listens_for(session, 'after_commit')
-    @event.listens_for(session, 'after_rollback')
-    def on_commit(session):
-        print("Done %s" % session._query_stats)
-
-def extract_user_stack(skip=1):
-    """Like traceback.extract_stack, but skips any sqlalchemy 
-    modules and only returns filenames """
-    try:
-        raise ZeroDivisionError
-    except ZeroDivisionError:
-        f = sys.exc_info()[2].tb_frame.f_back 
-    list = []
-
-    while f is not None and skip > 0:
-        f = f.f_back
-        skip -= 1
-
-    skipping = True
-    while f is not None:
-        lineno = f.f_lineno
-        co = f.f_code
-        module = inspect.getmodule(co)
-        if skipping and not module.__name__.startswith('sqlalchemy'):
-            skipping = False
-        if not skipping:
-            name = co.co_name  
-            list.append((module.__name__, name, lineno))
-        f = f.f_back
-    list.reverse()
-    return list
\ No newline at end of file
+    started = conn.info.get('query_start_time')
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    for instrumentation in get_instrumentations(conn.engine):
+        instrumentation.record(
+            statement,
+            seconds,
+            getattr(cursor,'rowcount',None))
@@ -0,0 +1,127 @@
+import csv
+import io
+import json
+import time
+import numpy
+import pandas
+
+def encode_column(col:pandas.Series)->list:
+    """
+    Values of a column as native python objects, nulls (NaN, NaT, 
+    pandas.NA) as None. Columns are converted one at a time with dtype
+    specific fast paths.
+    """
+    dtype = col.dtype
+    if isinstance(dtype,numpy.dtype):
+        if dtype.kind in 'iub':
+            # numpy ints and bools can not hold nulls
+            return col.to_numpy().tolist()
+        if dtype.kind == 'f':
+            values = col.to_numpy()
+            out = values.tolist()
+            for i in numpy.flatnonzero(numpy.isnan(values)):
+                out[i] = None
+            return out
+    # datetimes, strings, nullable extension types, categoricals...
+    values = col.to_numpy(dtype=object,copy=True)
+    mask = col.isna().to_numpy()
+    if mask.any():
+        values[mask] = None
+    return values.tolist()
+
+def iter_rows(df:pandas.DataFrame,page_size:int=10000):
+    """
+    Yield df rows as tuples, encoding page_size rows at a time.
+
+    Works as the argslist of psycopg2 execute_values, which consumes 
+    iterators page by page.
+    """
+    page_size = max(int(page_size),1)
+    for start in range(0,len(df),page_size):
+        page = df.iloc[start:start+page_size]
+        columns = [encode_column(page.iloc[:,i]) for i in range(page.shape[1])]
+        yield from zip(*columns)
+
+def encode_rows(df:pandas.DataFrame)->list:
+    return list(iter_rows(df,page_size=max(len(df),1)))
+
+def whole_floats_as_int(df:pandas.DataFrame)->pandas.DataFrame:
+    """
+    Float columns holding only whole numbers (integer columns with
+    nulls) as nullable Int64, so they are written 1 and not 1.0.
+    """
+    columns = {}
+    for name in df.columns:
+        col = df[name]
+        if not (isinstance(col.dtype,numpy.dtype) and col.dtype.kind == 'f'):
+            continue
+        values = col.to_numpy()
+        values = values[~numpy.isnan(values)]
+        if len(values) and (numpy.abs(values) < 2**53).all() \
+            and (values == numpy.floor(values)).all():
+            columns[name] = col.astype('Int64')
+    return df.assign(**columns) if columns else df
+
+class _CsvNull(float):
+    # numeric for the csv writer, so it is written unquoted and empty
+    def __str__(self):
+        return ''
+    __repr__ = __str__
+
+_CSV_NULL = _CsvNull()
+
+def copy_csv(df:pandas.DataFrame,page_size:int=10000)->str:
+    """
+    df as csv for COPY ... WITH (FORMAT csv): nulls are unquoted empty
+    fields and every text value is quoted, so empty strings and any
+    text ('\\N' included) never read back as NULL.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer,quoting=csv.QUOTE_NONNUMERIC,lineterminator='\n')
+    writer.writerows(
+        tuple(_CSV_NULL if value is None else value for value in row)
+        for row in iter_rows(whole_floats_as_int(df),page_size))
+    return buffer.getvalue()
+
+def _sample_frame(rows:int)->pandas.DataFrame:
+    rng = numpy.random.default_rng(0)
+    floats = rng.random(rows)
+    floats[::10] = numpy.nan
+    dates = pandas.Series(
+        pandas.date_range('2020-01-01',periods=rows,freq='min'))
+    dates[::20] = pandas.NaT
+    return pandas.DataFrame({
+        'id':numpy.arange(rows),
+        'amount':floats,
+        'created_at':dates,
+        'active':rng.random(rows) > 0.5,
+        'name':pandas.Series(rng.integers(0,1000,rows)).astype(str),
+        'qty':pandas.array(rng.integers(0,100,rows),dtype='Int64')
+    })
+
+def benchmark_encoder(rows:int=200000,repeat:int=3,df:pandas.DataFrame=None)->dict:
+    """
+    Compare the encoder with the historical [tuple(x) for x in df.values]
+    path, best of `repeat` runs in seconds.
+    """
+    if df is None:
+        df = _sample_frame(rows)
+    def best(fn):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
+    legacy = best(lambda: [tuple(x) for x in df.values])
+    encoder = best(lambda: sum(1 for _ in iter_rows(df)))
+    return {
+        'rows':len(df),
+        'columns':int(df.shape[1]),
+        'legacy_seconds':round(legacy,4),
+        'encoder_seconds':round(encoder,4),
+        'speedup':round(legacy / encoder,2) if encoder else None
+    }
+
+if __name__ == '__main__':
+    print(json.dumps(benchmark_encoder(),indent=4))
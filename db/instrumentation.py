@@ -0,0 +1,222 @@
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+# logging
+import logging
+logging.basicConfig(
+    stream=sys.stdout,
+    level=logging.INFO,
+    format='[%(asctime)s] %(levelname)s - %(message)s'
+    )
+logger = logging.getLogger()
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|:\w+|\?')
+_VALUE_LIST = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+# fingerprint collecting the statements past max_fingerprints
+OVERFLOW_FINGERPRINT = 'other'
+
+def extract_user_stack(skip=1,limit=20):
+    """
+    Frames of the caller as (module, function, line), skipping the
+    sqlalchemy internals and keeping at most limit frames.
+    """
+    frame = sys._getframe(1)
+    while frame is not None and skip > 0:
+        frame = frame.f_back
+        skip -= 1
+    stack = []
+    while frame is not None and len(stack) < limit:
+        module = frame.f_globals.get('__name__','')
+        if not module.startswith('sqlalchemy'):
+            stack.append((module, frame.f_code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def statement_fingerprint(statement:str)->str:
+    """
+    Statement with literals and parameters replaced by ?, so the
+    executions of the same query share one fingerprint.
+    """
+    fingerprint = _STRING_LITERAL.sub('?',str(statement))
+    fingerprint = _NUMBER_LITERAL.sub('?',fingerprint)
+    fingerprint = _PLACEHOLDER.sub('?',fingerprint)
+    fingerprint = _VALUE_LIST.sub('(?)',fingerprint)
+    return _WHITESPACE.sub(' ',fingerprint).strip()
+
+class QueryStatementStats:
+    """
+    Aggregated executions of one fingerprint. Latencies are kept in a
+    reservoir of max_samples entries for the percentiles.
+    """
+    def __init__(self,max_samples:int=1024):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.max_samples = max_samples
+        self.samples = []
+        self.stack = None
+
+    def add(self,seconds:float,rows:int):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds,seconds)
+        if rows is not None and rows > 0:
+            self.rows += rows
+        if len(self.samples) < self.max_samples:
+            self.samples.append(seconds)
+        else:
+            index = random.randrange(self.count)
+            if index < self.max_samples:
+                self.samples[index] = seconds
+
+    def percentile(self,q:float)->float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+        return ordered[index]
+
+    def as_dict(self)->dict:
+        return {
+            'count':self.count,
+            'total_seconds':self.total_seconds,
+            'mean_seconds':self.total_seconds / self.count if self.count else 0.0,
+            'max_seconds':self.max_seconds,
+            'p50_seconds':self.percentile(0.50),
+            'p95_seconds':self.percentile(0.95),
+            'p99_seconds':self.percentile(0.99),
+            'rows':self.rows,
+            'stack':self.stack
+        }
+
+class QueryInstrumentation:
+    """
+    Per fingerprint statistics of the executed statements.
+
+    Memory is bounded by max_fingerprints and max_samples. The caller
+    stack is only captured for a stack_sample_rate fraction of the
+    executions, 0 disables it.
+    """
+    def __init__(self,
+            stack_sample_rate:float=0.0,
+            max_fingerprints:int=500,
+            max_samples:int=1024):
+        self.stack_sample_rate = float(stack_sample_rate)
+        self.max_fingerprints = int(max_fingerprints)
+        self.max_samples = int(max_samples)
+        self.statements = {}
+        self.count = 0
+        self.total_time = 0.0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def record(self,statement:str,seconds:float,rows:int=None):
+        fingerprint = statement_fingerprint(statement)
+        stack = None
+        if self.stack_sample_rate > 0 and random.random() < self.stack_sample_rate:
+            stack = extract_user_stack(2)
+        with self._lock:
+            stats = self.statements.get(fingerprint)
+            if stats is None:
+                if len(self.statements) >= self.max_fingerprints:
+                    fingerprint = OVERFLOW_FINGERPRINT
+                stats = self.statements.setdefault(
+                    fingerprint,
+                    QueryStatementStats(self.max_samples))
+            stats.add(seconds,rows)
+            if stack is not None:
+                stats.stack = stack
+            self.count += 1
+            self.total_time += seconds
+
+    def summary(self)->dict:
+        with self._lock:
+            statements = {
+                fingerprint: stats.as_dict()
+                for fingerprint, stats in self.statements.items()}
+        return {
+            'count':self.count,
+            'total_seconds':self.total_time,
+            'statements':statements
+        }
+
+    def to_json(self,path:str):
+        with open(path,'w') as f:
+            json.dump(self.summary(),f,indent=2,default=str)
+
+    def to_prometheus(self,path:str,pipeline:str=''):
+        """
+        Prometheus textfile (node_exporter textfile collector format).
+        """
+        summary = self.summary()
+        lines = [
+            '# TYPE borderliner_query_seconds summary',
+            '# TYPE borderliner_query_rows_total counter'
+        ]
+        for index, (fingerprint, stats) in enumerate(
+                sorted(summary['statements'].items())):
+            query = fingerprint[:200].replace('\\','\\\\').replace('"','\\"')
+            labels = f'pipeline="{pipeline}",query_id="{index}",query="{query}"'
+            for q in ('50','95','99'):
+                lines.append(
+                    f'borderliner_query_seconds{{{labels},quantile="0.{q}"}} {stats["p"+q+"_seconds"]}')
+            lines.append(f'borderliner_query_seconds_sum{{{labels}}} {stats["total_seconds"]}')
+            lines.append(f'borderliner_query_seconds_count{{{labels}}} {stats["count"]}')
+            lines.append(f'borderliner_query_rows_total{{{labels}}} {stats["rows"]}')
+        # write then rename so the collector never reads a partial file
+        with open(path + '.tmp','w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp',path)
+
+    def export(self,path:str,format:str='json',pipeline:str=''):
+        match str(format).upper():
+            case 'PROMETHEUS':
+                self.to_prometheus(path,pipeline)
+            case _:
+                self.to_json(path)
+        logger.info(f'query statistics exported to {path}')
+
+    def __repr__(self):
+        return '<QueryInstrumentation count=%d time=%.2fs>' % (self.count, self.total_time)
+
+# instrumentations fed by the events of each engine, every pipeline
+# attaches its own to the engines it uses
+_engine_instrumentations = {}
+_engine_instrumentations_lock = threading.Lock()
+
+def install_instrumentation(instrumentation:QueryInstrumentation,engines:list):
+    """
+    Record the statements run on engines into instrumentation.
+    """
+    with _engine_instrumentations_lock:
+        for engine in engines:
+            if engine is None:
+                continue
+            attached = _engine_instrumentations.setdefault(engine,[])
+            if instrumentation not in attached:
+                attached.append(instrumentation)
+
+def uninstall_instrumentation(instrumentation:QueryInstrumentation):
+    """
+    Stop recording into instrumentation, the others keep recording.
+    """
+    with _engine_instrumentations_lock:
+        for engine, attached in list(_engine_instrumentations.items()):
+            if instrumentation in attached:
+                attached.remove(instrumentation)
+            if not attached:
+                _engine_instrumentations.pop(engine)
+
+def get_instrumentations(engine)->list:
+    return list(_engine_instrumentations.get(engine,()))
@@ -1,9 +1,9 @@
 from . import conn_abstract
-from pandas._libs.lib import infer_dtype
+from .encoders import copy_csv, iter_rows
+import io
 from psycopg2.extras import execute_values
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm.session import Session
-import warnings
 import pandas
 from sqlalchemy.sql import text
 from psycopg2 import Timestamp
@@ -20,67 +20,22 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
                 'password',
                 'port'
             ]
-        
+        # values: multi-row INSERT through execute_values
+        # copy: COPY FROM STDIN into a temp table + one merge statement
+        self.load_method = str(kwargs.get('load_method','values')).lower()
+        self.execution_metrics['staged_rows'] = 0
 
     @staticmethod
-    def _sql_type_name(col_type):
-
-        from pandas.io.sql import _SQL_TYPES
-
-        if col_type == 'timedelta64':
-            warnings.warn("the 'timedelta' type is not supported, and will be "
-                          "written as integer values (ns frequency) to the "
-                          "database.", UserWarning, stacklevel=8)
-            col_type = "integer"
-
-        elif col_type == "datetime64":
-            col_type = "datetime"
-
-        elif col_type == "empty":
-            col_type = "string"
-
-        elif col_type == "complex":
-            raise ValueError('Complex datatypes not supported')
-
-        if col_type not in _SQL_TYPES:
-            col_type = "string"
-
-        return _SQL_TYPES[col_type]
-
-    #@staticmethod
-    def column_exists_db(
-        self,
-        active_connection:Engine,
-        table_name, 
-        column_name, 
-        dtype, 
-        if_not_exists='append'):
+    def _drop_duplicate_keys(df:pandas.DataFrame,conflict_key:str):
         """
-        Check if colunm exists on db.
-
-        @TODO: This only works with postgres databases. Need a method 
-        for all attended databases types.
+        A statement can not touch the same key twice in one
+        ON CONFLICT DO UPDATE, keep the last occurrence like the old
+        row by row upsert did.
         """
-        q = f"SELECT count(*) FROM information_schema.columns " \
-            f"where table_name = '{table_name}' and column_name = '{column_name}'"
-        conn = active_connection
-        try:          
-            if conn.execute(q).fetchone()[0] == 1:
-                return 0
-            elif conn.execute(q).fetchone()[0] == 0 and if_not_exists == 'append':
-                dt = PostgresBackend._sql_type_name(dtype.__str__())
-                qc = f"ALTER TABLE {table_name} ADD COLUMN {column_name.lower()} {dt}"
-                conn.execute(qc)
-                #active_connection.commit()
-                #self.logger.log(self.logger.CRITICAL, ("%s column didn't existed in the %s. Added." % (column_name, table_name)))
-                return 0
-            else:
-                print(conn.execute(q).fetchone())
-                # TODO: the table wasn't altered.
-                exit(1)
-        except Exception as e:
-            print('COL EXISTS EXCEPTION',e)
-            raise e
+        key_cols = [str(e).strip() for e in conflict_key.split(',')]
+        if df.duplicated(subset=key_cols).any():
+            return df.drop_duplicates(subset=key_cols,keep='last')
+        return df
 
     def insert_on_conflict(
         self, 
@@ -94,20 +49,29 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
         """
         Process method to insert dataframes in database target.
         """
+        if self.load_method == 'copy':
+            return self.copy_on_conflict(
+                active_connection,
+                df,
+                schema,
+                table_name,
+                if_exists=if_exists,
+                conflict_key=conflict_key,
+                conflict_action=conflict_action)
         try:
-            connection = active_connection.raw_connection()
+            connection = self.acquire_connection(active_connection)
             cursor = connection.cursor()
             self.execution_metrics['processed_rows'] += len(df)
             if if_exists == 'append':
-                for column in df.columns:
-                    res = self.column_exists_db(
-                        active_connection,
-                        table_name, 
-                        column, 
-                        infer_dtype(df[column]))
+                self.ensure_columns(
+                    active_connection,
+                    df,
+                    schema,
+                    table_name)
+                self.begin_chunk(cursor)
                 
                 col_names = ','.join(str(e) for e in df.columns)
-                data = [tuple(x) for x in df.values]
+                data = iter_rows(df,self.page_size)
                 
                 if conflict_key != None:                    
                     conflict_set = ','.join(str(e) for e in df.columns)
@@ -117,29 +81,36 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
                     match str(conflict_action).lower():
                         case 'update':
                             try:
-                                for d in data:
-                                    INSERT_SQL = f"""
-                                        WITH t as (
-                                        INSERT INTO {schema}.{table_name} ({col_names})
-                                            VALUES {d}
-                                        ON CONFLICT 
-                                            ({conflict_key}) 
-                                        DO UPDATE SET
-                                            ({conflict_set})=({excluded_set}) RETURNING xmax)
-                                            SELECT COUNT(*) AS all_rows, 
-                                            SUM(CASE WHEN xmax = 0 THEN 1 ELSE 0 END) AS ins, 
-                                            SUM(CASE WHEN xmax::text::int > 0 THEN 1 ELSE 0 END) AS upd 
-                                        FROM t;"""
-                                    
-                                    cursor.execute(INSERT_SQL)
-                                    metrics = cursor.fetchall()
-                                    inserts = metrics[0][1]
-                                    updates = metrics[0][2]
-                                    self.execution_metrics['inserted_rows'] += int(inserts)
-                                    self.execution_metrics['updated_rows'] += int(updates)
+                                deduped = self._drop_duplicate_keys(
+                                    df,
+                                    conflict_key)
+                                if len(deduped) != len(df):
+                                    data = iter_rows(deduped,self.page_size)
+                                INSERT_SQL = f"""
+                                    WITH t as (
+                                    INSERT INTO {schema}.{table_name} ({col_names})
+                                        VALUES %s
+                                    ON CONFLICT 
+                                        ({conflict_key}) 
+                                    DO UPDATE SET
+                                        ({conflict_set})=({excluded_set}) RETURNING xmax)
+                                        SELECT COUNT(*) AS all_rows, 
+                                        SUM(CASE WHEN xmax = 0 THEN 1 ELSE 0 END) AS ins, 
+                                        SUM(CASE WHEN xmax::text::int > 0 THEN 1 ELSE 0 END) AS upd 
+                                    FROM t;"""
+                                # one row of counters is returned per page
+                                pages = execute_values(
+                                        cursor, 
+                                        INSERT_SQL, 
+                                        data, 
+                                        template=None, 
+                                        page_size=self.page_size,
+                                        fetch=True)
+                                for page in pages:
+                                    self.execution_metrics['inserted_rows'] += int(page[1] or 0)
+                                    self.execution_metrics['updated_rows'] += int(page[2] or 0)
                                     
                             except Exception as e:
-                                #print(values,INSERT_SQL)
                                 print('EXCEPTION PGLIBS:',e)
                                 raise e
                         case 'nothing':
@@ -154,7 +125,7 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
                                         INSERT_SQL, 
                                         data, 
                                         template=None, 
-                                        page_size=10000)
+                                        page_size=self.page_size)
                                 self.execution_metrics['inserted_rows'] += cursor.rowcount
                 else:
                     INSERT_SQL = f"""
@@ -165,13 +136,112 @@ class PostgresBackend(conn_abstract.DatabaseBackend):
                                     INSERT_SQL, 
                                     data, 
                                     template=None, 
-                                    page_size=10000)
+                                    page_size=self.page_size)
+                    self.execution_metrics['inserted_rows'] += cursor.rowcount
+                
+                self.end_chunk(connection,len(df))
+                cursor.close()
+                self.release_connection()
+                
+        except Exception as e:            
+            self.fail_chunk()
+            raise Exception('db exception:'+str(e))
+
+    def copy_on_conflict(
+        self, 
+        active_connection:Engine,
+        df:pandas.DataFrame, 
+        schema,
+        table_name,
+        if_exists='append',
+        conflict_key=None,
+        conflict_action=None):
+        """
+        Bulk load strategy using COPY FROM STDIN.
+
+        The dataframe is encoded as csv into an in-memory buffer and 
+        streamed into a session temp table, then merged into 
+        schema.table_name with a single INSERT ... SELECT statement.
+        """
+        try:
+            connection = self.acquire_connection(active_connection)
+            cursor = connection.cursor()
+            self.execution_metrics['processed_rows'] += len(df)
+            if if_exists == 'append':
+                self.ensure_columns(
+                    active_connection,
+                    df,
+                    schema,
+                    table_name)
+                self.begin_chunk(cursor)
+                
+                if isinstance(conflict_key,list):
+                    conflict_key = ','.join(str(e) for e in conflict_key)
+                if conflict_key != None \
+                    and str(conflict_action).lower() == 'update':
+                    df = self._drop_duplicate_keys(df,conflict_key)
+
+                col_names = ','.join(str(e) for e in df.columns)
+                stage_table = f'{table_name}_copy_stage'
+                cursor.execute(f"""
+                    DROP TABLE IF EXISTS {stage_table};
+                    CREATE TEMP TABLE {stage_table} AS
+                        SELECT {col_names} FROM {schema}.{table_name}
+                        WITH NO DATA;""")
+                
+                buffer = io.StringIO(copy_csv(df,self.page_size))
+                cursor.copy_expert(
+                    f"""COPY {stage_table} ({col_names}) 
+                        FROM STDIN WITH (FORMAT csv)""",
+                    buffer)
+                self.execution_metrics['staged_rows'] += cursor.rowcount
+                buffer.close()
+
+                SELECT_SQL = f"SELECT {col_names} FROM {stage_table}"
+                if conflict_key != None:
+                    match str(conflict_action).lower():
+                        case 'update':
+                            conflict_set = ','.join(str(e) for e in df.columns)
+                            excluded_set = ','.join('EXCLUDED.' + str(e) for e in df.columns)
+                            MERGE_SQL = f"""
+                                WITH t as (
+                                INSERT INTO {schema}.{table_name} ({col_names})
+                                    {SELECT_SQL}
+                                ON CONFLICT 
+                                    ({conflict_key}) 
+                                DO UPDATE SET
+                                    ({conflict_set})=({excluded_set}) RETURNING xmax)
+                                    SELECT COUNT(*) AS all_rows, 
+                                    SUM(CASE WHEN xmax = 0 THEN 1 ELSE 0 END) AS ins, 
+                                    SUM(CASE WHEN xmax::text::int > 0 THEN 1 ELSE 0 END) AS upd 
+                                FROM t;"""
+                            cursor.execute(MERGE_SQL)
+                            metrics = cursor.fetchone()
+                            self.execution_metrics['inserted_rows'] += int(metrics[1] or 0)
+                            self.execution_metrics['updated_rows'] += int(metrics[2] or 0)
+                        case 'nothing':
+                            MERGE_SQL = f"""
+                                INSERT INTO {schema}.{table_name} ({col_names})
+                                    {SELECT_SQL}
+                                ON CONFLICT 
+                                    ({conflict_key}) 
+                                DO NOTHING """
+                            cursor.execute(MERGE_SQL)
+                            self.execution_metrics['inserted_rows'] += cursor.rowcount
+                else:
+                    MERGE_SQL = f"""
+                        INSERT INTO {schema}.{table_name} ({col_names})
+                            {SELECT_SQL}
+                        """
+                    cursor.execute(MERGE_SQL)
                     self.execution_metrics['inserted_rows'] += cursor.rowcount
                 
-                connection.commit()                                
+                cursor.execute(f'DROP TABLE IF EXISTS {stage_table};')
+                self.end_chunk(connection,len(df))
                 cursor.close()
-                connection.close()
+                self.release_connection()
                 
         except Exception as e:            
+            self.fail_chunk()
             raise Exception('db exception:'+str(e))
 Connection = PostgresBackend
\ No newline at end of file
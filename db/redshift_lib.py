@@ -1,9 +1,14 @@
 from . import conn_abstract
-from pandas._libs.lib import infer_dtype
+from .encoders import iter_rows
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy
 from psycopg2.extras import execute_values
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm.session import Session
-import warnings
 import pandas
 from sqlalchemy.sql import text
 from psycopg2 import Timestamp
@@ -23,66 +28,49 @@ class RedshiftBackend(conn_abstract.DatabaseBackend):
         self.staging_schema = kwargs.get('staging_schema','staging')
         self.staging_table = kwargs.get('staging_table',None)
         self.execution_metrics['staged_rows'] = 0
+        self.multiple_add_column = False
+        self.supports_savepoints = False
+        # values: multi-row INSERT into the staging table
+        # copy: dump chunk files to storage and COPY them with a manifest
+        self.load_method = str(kwargs.get('load_method','values')).lower()
+        self.copy_format = str(kwargs.get('copy_format','csv')).lower()
+        self.copy_compression = kwargs.get('copy_compression','gzip')
+        self.copy_iam_role = kwargs.get('copy_iam_role',None)
+        self.copy_slices = kwargs.get('copy_slices',None)
+        # any object exposing upload_file_to_storage (CloudEnvironment)
+        self.storage_env = kwargs.get('storage_env',None)
+        self.storage_root = kwargs.get('storage_root',None)
+        self.storage_prefix = kwargs.get('storage_prefix','')
+        # merge, delete_insert or update_insert
+        self.merge_strategy = str(kwargs.get('merge_strategy','update_insert')).lower()
+        self.execution_metrics[f'{self.merge_strategy}_seconds'] = 0.0
 
-    @staticmethod
-    def _sql_type_name(col_type):
-
-        from pandas.io.sql import _SQL_TYPES
-
-        if col_type == 'timedelta64':
-            warnings.warn("the 'timedelta' type is not supported, and will be "
-                          "written as integer values (ns frequency) to the "
-                          "database.", UserWarning, stacklevel=8)
-            col_type = "integer"
-
-        elif col_type == "datetime64":
-            col_type = "datetime"
-
-        elif col_type == "empty":
-            col_type = "string"
-
-        elif col_type == "complex":
-            raise ValueError('Complex datatypes not supported')
-
-        if col_type not in _SQL_TYPES:
-            col_type = "string"
-
-        return _SQL_TYPES[col_type]
-
-    #@staticmethod
-    def column_exists_db(
-        self,
-        active_connection:Engine,
-        table_name, 
-        column_name, 
-        dtype, 
-        if_not_exists='append'):
+    def staging_relation(self,cursor,schema,table_name)->str:
         """
-        Check if colunm exists on db.
+        Empty staging table for the chunk.
 
-        @TODO: This only works with postgres databases. Need a method 
-        for all attended databases types.
+        Without a configured staging_table a temp table shaped like the
+        target (defaults included) is recreated for every chunk, so
+        concurrent loaders never share staging rows and a pooled session
+        never sees a stale one.
         """
-        q = f"SELECT count(*) FROM information_schema.columns " \
-            f"where table_name = '{table_name}' and column_name = '{column_name}'"
-        conn = active_connection
-        try:          
-            if conn.execute(q).fetchone()[0] == 1:
-                return 0
-            elif conn.execute(q).fetchone()[0] == 0 and if_not_exists == 'append':
-                dt = RedshiftBackend._sql_type_name(dtype.__str__())
-                qc = f"ALTER TABLE {table_name} ADD COLUMN {column_name.lower()} {dt}"
-                conn.execute(qc)
-                #active_connection.commit()
-                #self.logger.log(self.logger.CRITICAL, ("%s column didn't existed in the %s. Added." % (column_name, table_name)))
-                return 0
-            else:
-                print(conn.execute(q).fetchone())
-                # TODO: the table wasn't altered.
-                exit(1)
-        except Exception as e:
-            print('COL EXISTS EXCEPTION',e)
-            raise e
+        if not self.staging_table:
+            stage = f'borderliner_stg_{table_name}'
+            cursor.execute(f'DROP TABLE IF EXISTS {stage};')
+            cursor.execute(
+                f'CREATE TEMP TABLE {stage} (LIKE {schema}.{table_name} INCLUDING DEFAULTS);')
+            return stage
+        stage = f'{self.staging_schema}.{self.staging_table}'
+        # TRUNCATE commits the open transaction on redshift
+        if self.batched_commits:
+            cursor.execute(f'DELETE FROM {stage};')
+        else:
+            cursor.execute(f'TRUNCATE TABLE {stage};')
+        return stage
+
+    @staticmethod
+    def _join_condition(left:str,right:str,keys:list)->str:
+        return ' AND \n'.join(f'{left}.{key} = {right}.{key}' for key in keys)
 
     def insert_on_conflict(
         self, 
@@ -95,85 +83,237 @@ class RedshiftBackend(conn_abstract.DatabaseBackend):
         conflict_action=None):
         """
         Process method to insert dataframes in database target.
+
+        Rows are staged, then merged with the configured merge_strategy:
+        merge (native MERGE), delete_insert or update_insert.
         """
         try:
-            connection = active_connection.raw_connection()
+            connection = self.acquire_connection(active_connection)
             cursor = connection.cursor()
             self.execution_metrics['processed_rows'] += len(df)
-            truncate_staging_statement = f'TRUNCATE TABLE {self.staging_schema}.{self.staging_table};'
-            cursor.execute(truncate_staging_statement)
-            join_key = ''
-            update_where_clause = ''
-            update_where_clause2 = ''
-            bulk_insert_where_clause = ''
-            if isinstance(conflict_key,list):
-                index = 0
-                for key in conflict_key:
-                    join_key += 'ods1.' +str(key)+' = '+'stg.'+key 
-                    update_where_clause += 'ods1.' +str(key)+' = '+'stg.'+key
-                    update_where_clause2 += 'ods.' +str(key)+' = '+'stg.'+key
-                    bulk_insert_where_clause += 'ods1.' +str(key)+' IS NULL'
-                    if index+1 < len(conflict_key):
-                        join_key += ' AND \n' 
-                        update_where_clause += ' AND \n'
-                        update_where_clause2 += ' AND \n'
-                        bulk_insert_where_clause += ' AND \n'
-                    index += 1
-
-                conflict_key = ','.join(str(e) for e in conflict_key)
-            else:
-                join_key = 'ods1.'+conflict_key+' = '+'stg.'+conflict_key
+            self.begin_chunk(cursor)
+            stage = self.staging_relation(cursor,schema,table_name)
 
-            data = [tuple(x) for x in df.values]
+            if isinstance(conflict_key,str):
+                conflict_key = [e.strip() for e in conflict_key.split(',')]
+            join_key = self._join_condition('ods','stg',conflict_key)
             col_names = ','.join(str(e) for e in df.columns)
-            update_set = ''
-            index = 0
-            for col in df.columns:
-                update_set += str(col) + ' = ' + 'stg.' + col 
-                if index+1 < len(df.columns):
-                        update_set += ',\n' 
-                index += 1
+            stg_names = ','.join('stg.' + str(e) for e in df.columns)
+            update_set = ',\n'.join(
+                f'{col} = stg.{col}' for col in df.columns)
+            target = f'{schema}.{table_name}'
             
             # save data in staging table
-            INSERT_SQL = f"""INSERT INTO {self.staging_schema}.{self.staging_table} ({col_names})
-                                        VALUES %s """
-            execute_values(
-                    cursor, 
-                    INSERT_SQL, 
-                    data, 
-                    template=None, 
-                    page_size=10000)
-            self.execution_metrics['staged_rows'] += cursor.rowcount
-            # update
-            if str(conflict_action).upper() == 'UPDATE':
-                UPDATE_SQL = f"""
-                    UPDATE {schema}.{table_name} ods SET {update_set}
-                    FROM (SELECT stg.* FROM  {self.staging_schema}.{self.staging_table} stg  
-                        LEFT JOIN {schema}.{table_name} ods1 
-                        ON {join_key} 
-                        WHERE {update_where_clause}) as stg
-                    WHERE {update_where_clause2}
-
-                """
-                cursor.execute(UPDATE_SQL)
-                
-                self.execution_metrics['updated_rows'] += cursor.rowcount
+            if self.load_method == 'copy':
+                self.copy_to_staging(cursor,df,stage)
+            else:
+                data = iter_rows(df,self.page_size)
+                INSERT_SQL = f"""INSERT INTO {stage} ({col_names})
+                                            VALUES %s """
+                execute_values(
+                        cursor, 
+                        INSERT_SQL, 
+                        data, 
+                        template=None, 
+                        page_size=self.page_size)
+                self.execution_metrics['staged_rows'] += len(df)
 
-            BULK_INSERT_SQL = f"""
-                INSERT INTO {schema}.{table_name}
-                (SELECT stg.* FROM {self.staging_schema}.{self.staging_table} stg
-                    LEFT JOIN {schema}.{table_name} ods1 
-                    ON {join_key} WHERE {bulk_insert_where_clause})
+            ANTI_JOIN_INSERT_SQL = f"""
+                INSERT INTO {target} ({col_names})
+                SELECT {stg_names} FROM {stage} stg
+                    LEFT JOIN {target} ods 
+                    ON {join_key} 
+                WHERE ods.{conflict_key[0]} IS NULL
             """
-
-            #print(BULK_INSERT_SQL)
-
-            cursor.execute(BULK_INSERT_SQL)
-            self.execution_metrics['inserted_rows'] += cursor.rowcount
-            connection.commit()                                
+            started = time.perf_counter()
+            if str(conflict_action).upper() != 'UPDATE':
+                cursor.execute(ANTI_JOIN_INSERT_SQL)
+                self.execution_metrics['inserted_rows'] += cursor.rowcount
+            else:
+                match self.merge_strategy:
+                    case 'merge':
+                        cursor.execute(f"""
+                            SELECT COUNT(*) FROM {stage} stg
+                                JOIN {target} ods ON {join_key}""")
+                        matched = int(cursor.fetchone()[0])
+                        cursor.execute(f"""
+                            MERGE INTO {target} AS ods USING {stage} stg
+                                ON {join_key}
+                            WHEN MATCHED THEN UPDATE SET {update_set}
+                            WHEN NOT MATCHED THEN INSERT ({col_names}) 
+                                VALUES ({stg_names})""")
+                        self.execution_metrics['updated_rows'] += matched
+                        self.execution_metrics['inserted_rows'] += cursor.rowcount - matched
+                    case 'delete_insert':
+                        # keep the stored values of the columns missing
+                        # in the chunk, new rows get the column defaults
+                        frame_columns = {str(e).lower() for e in df.columns}
+                        extra = [
+                            col for col in self.get_table_columns(
+                                active_connection,schema,table_name)
+                            if col not in frame_columns]
+                        if extra:
+                            cursor.execute(f"""
+                                UPDATE {stage} SET {', '.join(f'{col} = ods.{col}' for col in extra)}
+                                FROM {target} ods
+                                WHERE {self._join_condition('ods',stage,conflict_key)}""")
+                        cursor.execute(f"""
+                            DELETE FROM {target} USING {stage} stg
+                            WHERE {self._join_condition(target,'stg',conflict_key)}""")
+                        deleted = cursor.rowcount
+                        insert_names = ','.join([col_names] + extra)
+                        cursor.execute(f"""
+                            INSERT INTO {target} ({insert_names})
+                            SELECT {insert_names} FROM {stage}""")
+                        self.execution_metrics['updated_rows'] += deleted
+                        self.execution_metrics['inserted_rows'] += cursor.rowcount - deleted
+                    case 'update_insert':
+                        cursor.execute(f"""
+                            UPDATE {target} ods SET {update_set}
+                            FROM {stage} stg
+                            WHERE {join_key}""")
+                        self.execution_metrics['updated_rows'] += cursor.rowcount
+                        cursor.execute(ANTI_JOIN_INSERT_SQL)
+                        self.execution_metrics['inserted_rows'] += cursor.rowcount
+                    case _:
+                        raise ValueError(
+                            f'Unknown merge strategy {self.merge_strategy}')
+            self.execution_metrics[f'{self.merge_strategy}_seconds'] += \
+                time.perf_counter() - started
+            self.end_chunk(connection,len(df))
             cursor.close()
-            connection.close()
+            self.release_connection()
                 
         except Exception as e:            
+            self.fail_chunk()
             raise Exception('db exception:'+str(e))
+
+    def get_slice_count(self,cursor)->int:
+        """
+        Number of files each chunk is split into, so every slice of the
+        cluster loads one file in parallel.
+        """
+        if self.copy_slices is None:
+            cursor.execute('SELECT COUNT(*) FROM stv_slices;')
+            self.copy_slices = int(cursor.fetchone()[0])
+        return max(int(self.copy_slices),1)
+
+    def _copy_file_options(self):
+        """
+        Returns file suffix and COPY format clause for the configured 
+        copy_format / copy_compression.
+        """
+        compression = str(self.copy_compression).lower()
+        match self.copy_format:
+            case 'parquet':
+                return '.parquet','FORMAT AS PARQUET'
+            case 'csv':
+                match compression:
+                    case 'gzip':
+                        return '.csv.gz',"FORMAT AS CSV GZIP NULL AS '\\\\N'"
+                    case 'zstd':
+                        return '.csv.zst',"FORMAT AS CSV ZSTD NULL AS '\\\\N'"
+                    case 'none':
+                        return '.csv',"FORMAT AS CSV NULL AS '\\\\N'"
+        raise ValueError(
+            f'Unsupported copy format {self.copy_format}/{self.copy_compression}')
+
+    def dump_copy_files(self,df:pandas.DataFrame,directory:str,parts:int):
+        """
+        Write df split in at most `parts` files inside directory.
+
+        Returns the list of written files.
+        """
+        suffix, _ = self._copy_file_options()
+        compression = str(self.copy_compression).lower()
+        token = os.path.basename(directory)
+        files = []
+        parts = max(min(parts,len(df)),1)
+        bounds = numpy.linspace(0,len(df),parts+1,dtype=int)
+        for index in range(parts):
+            filename = os.path.join(
+                directory,
+                f'{token}_{str(index).zfill(4)}{suffix}')
+            part = df.iloc[bounds[index]:bounds[index+1]]
+            if self.copy_format == 'parquet':
+                part.to_parquet(
+                    filename,
+                    index=False,
+                    compression=None if compression == 'none' else compression)
+            else:
+                part.to_csv(
+                    filename,
+                    header=False,
+                    index=False,
+                    na_rep='\\N',
+                    compression=None if compression == 'none' else compression)
+            files.append(filename)
+        return files
+
+    def write_manifest(self,files:list,manifest_file:str):
+        """
+        Upload files to storage and write the COPY manifest for them.
+
+        Returns the storage url of the manifest.
+        """
+        if self.storage_env is None or not self.storage_root:
+            raise ValueError('copy load method requires a storage environment')
+        prefix = str(self.storage_prefix).strip('/')
+        entries = []
+        for filename in files:
+            object_name = os.path.basename(filename)
+            if prefix:
+                object_name = prefix + '/' + object_name
+            uploaded = self.storage_env.upload_file_to_storage(
+                file_name=filename,
+                storage_root=self.storage_root,
+                object_name=object_name)
+            if uploaded is False:
+                raise Exception(f'failed to upload {filename} to storage')
+            entries.append({
+                'url':f's3://{self.storage_root}/{object_name}',
+                'mandatory':True,
+                'meta':{'content_length':os.path.getsize(filename)}
+            })
+        with open(manifest_file,'w') as f:
+            json.dump({'entries':entries},f)
+        object_name = os.path.basename(manifest_file)
+        if prefix:
+            object_name = prefix + '/' + object_name
+        uploaded = self.storage_env.upload_file_to_storage(
+            file_name=manifest_file,
+            storage_root=self.storage_root,
+            object_name=object_name)
+        if uploaded is False:
+            raise Exception(f'failed to upload manifest {manifest_file} to storage')
+        return f's3://{self.storage_root}/{object_name}'
+
+    def copy_to_staging(self,cursor,df:pandas.DataFrame,stage:str):
+        """
+        Fill the stage table with a single COPY from storage.
+        """
+        if not self.copy_iam_role:
+            raise ValueError('copy load method requires copy_iam_role')
+        _, format_clause = self._copy_file_options()
+        col_names = ','.join(str(e) for e in df.columns)
+        directory = tempfile.mkdtemp(prefix='borderliner_copy_')
+        try:
+            files = self.dump_copy_files(
+                df,
+                directory,
+                self.get_slice_count(cursor))
+            manifest = self.write_manifest(
+                files,
+                os.path.join(directory,os.path.basename(directory)+'.manifest'))
+            COPY_SQL = f"""
+                COPY {stage} ({col_names})
+                FROM '{manifest}'
+                IAM_ROLE '{self.copy_iam_role}'
+                MANIFEST
+                {format_clause};"""
+            cursor.execute(COPY_SQL)
+            cursor.execute('SELECT pg_last_copy_count();')
+            self.execution_metrics['staged_rows'] += int(cursor.fetchone()[0])
+        finally:
+            shutil.rmtree(directory,ignore_errors=True)
 Connection = RedshiftBackend
\ No newline at end of file